@@ -0,0 +1,180 @@
+import os
+import json
+import threading
+import functools
+import collections
+
+from ..XmlReaderWriter import XmlReader, XmlWriter
+from ..log import *
+
+
+PROJECT_LIST = 'project_list'
+PROJECT_TRASH_LIST = 'project_trash_list'
+FILE_LIST = 'file_list'
+FILE_TRASH_LIST = 'file_trash_list'
+
+
+class CuemsListCache():
+    """ Json encoded library lists, shared by all users and invalidated by the db methods that modify them.
+    build functions return (library change seq, list), get returns (seq, json encoded list)
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.payloads = dict()
+        self.generations = dict()
+        self.build_locks = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name, build):
+        with self.lock:
+            if name in self.payloads:
+                self.hits += 1
+                return self.payloads[name]
+            build_lock = self.build_locks.setdefault(name, threading.Lock())
+
+        with build_lock:    # only one thread queries and encodes a list, the rest wait and reuse its result
+            with self.lock:
+                if name in self.payloads:
+                    self.hits += 1
+                    return self.payloads[name]
+                self.misses += 1
+                generation = self.generations.get(name, 0)
+
+            seq, value = build()
+            payload = (seq, json.dumps(value))
+
+            with self.lock:
+                if self.generations.get(name, 0) == generation:   # do not store a list modified while we were building it
+                    self.payloads[name] = payload
+        return payload
+
+    def invalidate(self, *names):
+        with self.lock:
+            for name in names:
+                self.payloads.pop(name, None)
+                self.generations[name] = self.generations.get(name, 0) + 1
+        logger.debug(f'list cache invalidated {names}')
+
+
+def invalidates(*names):
+    """ Decorator for db methods, drops the cached lists once the method (and its transaction) has ended """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self.list_cache.invalidate(*names)
+        return wrapper
+    return decorator
+
+
+PROJECT_CACHE_BYTES = 64 * 1024 * 1024
+
+
+class CuemsProjectCache():
+    """ Parsed project dicts by script.xml path, valid while the file keeps the same mtime, size and inode.
+    Bounded by the size of the xml files it holds, least recently used projects are dropped first.
+    Cached dicts are shared, callers must not modify them.
+    """
+
+    def __init__(self, capacity=PROJECT_CACHE_BYTES):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()   # path: (file signature, size, project dict)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def signature(path):
+        stat = os.stat(path)
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino), stat.st_size
+
+    def get(self, path, read):
+        signature, size = self.signature(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == signature:
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+
+        data = read()
+        self.put(path, data, signature, size)
+        return data
+
+    def put(self, path, data, signature=None, size=None):
+        if signature is None:
+            signature, size = self.signature(path)
+        with self.lock:
+            self.discard(path)
+            if size > self.capacity:
+                return
+            self.entries[path] = (signature, size, data)
+            self.size += size
+            while self.size > self.capacity:
+                _, (_, old_size, _) = self.entries.popitem(last=False)
+                self.size -= old_size
+
+    def invalidate(self, path):
+        with self.lock:
+            self.discard(path)
+
+    def discard(self, path):
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.size, 'capacity': self.capacity, 'hits': self.hits, 'misses': self.misses}
+
+
+class CuemsSchemaCache():
+    """ XmlReader and XmlWriter with the script schema already compiled, reused for every read and write.
+    Each thread gets its own instances, they are not thread safe. They are built again when the xsd file changes.
+    """
+
+    def __init__(self, xsd_path):
+        self.xsd_path = xsd_path
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.version = self.schema_version()   # fails at startup if the schema is missing
+        self.builds = 0
+
+    def schema_version(self):
+        stat = os.stat(self.xsd_path)
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def reader(self, xmlfile):
+        return self.instance(XmlReader, xmlfile)
+
+    def writer(self, xmlfile):
+        return self.instance(XmlWriter, xmlfile)
+
+    def instance(self, xml_class, xmlfile):
+        version = self.schema_version()
+        with self.lock:
+            if version != self.version:
+                logger.info('script schema {} changed, reloading it'.format(self.xsd_path))
+                self.version = version
+
+        instances = self.local.__dict__.setdefault('instances', dict())
+        cached = instances.get(xml_class)
+        if cached is not None and cached[0] == version:
+            cached[1].xmlfile = xmlfile
+            return cached[1]
+
+        instance = xml_class(schema = self.xsd_path, xmlfile = xmlfile)
+        # reuse only pays while XmlReaderWriter compiles the xsd into schema_object in __init__ and reads
+        # self.xmlfile on every read() and write_from_object(), as setting .xmlfile above relies on
+        assert hasattr(instance, 'schema_object'), '{} no longer keeps its compiled schema in schema_object'.format(xml_class.__name__)
+        instances[xml_class] = (version, instance)
+        with self.lock:
+            self.builds += 1
+        logger.debug('script schema compiled for {} in thread {}'.format(xml_class.__name__, threading.current_thread().name))
+        return instance
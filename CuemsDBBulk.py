@@ -0,0 +1,74 @@
+import os
+import shutil
+import concurrent.futures
+
+from .CuemsUtils import CopyMoveVersioned
+from ..log import *
+
+
+BULK_FS_WORKERS = 8
+BULK_OK = 'OK'
+
+
+def run_parallel(function, items, workers=BULK_FS_WORKERS):
+    """ Calls function on every item from a thread pool, returns the (item, exception) of the calls that failed """
+    errors = list()
+    if not items:
+        return errors
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(workers, len(items)), thread_name_prefix='ws_BulkFS') as pool:
+        futures = {pool.submit(function, item): item for item in items}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                errors.append((futures[future], e))
+    return errors
+
+
+def move_files(moves):
+    """ Moves every (orig path, dest folder, required) in order, the not required ones only if they exist.
+    Returns the (dest path, orig path) of the moved files; if one move fails the previous ones are put back
+    """
+    done = list()
+    try:
+        for orig_path, dest_folder, required in moves:
+            if not required and not os.path.exists(orig_path):
+                continue
+            dest_filename = CopyMoveVersioned.move(orig_path, dest_folder)
+            done.append((os.path.join(dest_folder, dest_filename), orig_path))
+    except Exception as e:
+        undo_moves(done)
+        raise e
+    return done
+
+
+def undo_moves(done):
+    for dest_path, orig_path in reversed(done):
+        if os.path.exists(dest_path):
+            shutil.move(dest_path, orig_path)
+
+
+def bulk_move(items, moves_of, update):
+    """ Moves the files of every item (key: db record) in parallel, then calls update(moved keys) once, in the caller transaction.
+    If update fails every move is undone. Returns {key: error message} of the items that could not be moved
+    """
+    moved = dict()
+    def move(key):
+        moved[key] = move_files(moves_of(items[key]))
+
+    failed = dict()
+    for key, e in run_parallel(move, list(items)):
+        logger.error("error: {} {}; triying to move {}".format(type(e), e, key))
+        failed[key] = str(e)
+    if not moved:
+        return failed
+
+    try:
+        update(list(moved))
+    except Exception as e:
+        logger.error("error: {} {}; bulk update failed, moving {} items back".format(type(e), e, len(moved)))
+        for key, undo_error in run_parallel(lambda key: undo_moves(moved[key]), list(moved)):
+            logger.error("error: {} {}; triying to move back {}".format(type(undo_error), undo_error, key))
+        for key in moved:
+            failed[key] = str(e)
+    return failed
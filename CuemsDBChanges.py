@@ -0,0 +1,83 @@
+from peewee import fn
+
+from .CuemsDBModel import LibraryChange
+from ..log import *
+
+
+ADDED = 'added'
+CHANGED = 'changed'
+REMOVED = 'removed'
+
+LIBRARY_CHANGES_KEPT = 10000 # older changes are pruned, clients asking from before them get a full list
+LIBRARY_CHANGES_PRUNE_EVERY = 500
+LIBRARY_DELTA_MAX_ITEMS = 500 # bigger deltas are sent as a full list
+
+
+class CuemsDBChanges():
+    """ Library change sequence, every list mutation is recorded with a monotonically increasing seq
+    so clients can ask only for what changed since the last list they got
+    """
+
+    def __init__(self, db_connection):
+        self.db = db_connection
+
+    def record(self, list_name, items, kind):
+        # call inside the transaction of the mutation, so the change is only visible if the mutation commits
+        seq = None
+        for item in items:
+            seq = LibraryChange.create(list_name=list_name, item=str(item), kind=kind).seq
+        if seq is not None and seq % LIBRARY_CHANGES_PRUNE_EVERY == 0:
+            LibraryChange.delete().where(LibraryChange.seq <= seq - LIBRARY_CHANGES_KEPT).execute()
+
+    def current_seq(self):
+        return LibraryChange.select(fn.MAX(LibraryChange.seq)).scalar() or 0
+
+    def since(self, list_name, since):
+        """ Returns {item: first change kind} of the items of list_name changed after since,
+        or None if since is too old (or unknown) to build a delta
+        """
+        current = self.current_seq()
+        oldest = LibraryChange.select(fn.MIN(LibraryChange.seq)).scalar()
+        if since > current or (oldest is not None and since < oldest - 1) or (oldest is None and since < current):
+            return None
+
+        changes = dict()
+        query = (LibraryChange
+                .select(LibraryChange.item, LibraryChange.kind)
+                .where((LibraryChange.list_name == list_name) & (LibraryChange.seq > since))
+                .order_by(LibraryChange.seq))
+        for change in query:
+            changes.setdefault(change.item, change.kind)
+        return changes
+
+    def snapshot(self, list_function):
+        """ Returns (seq, list) read in the same transaction, so the seq matches the list """
+        with self.db.atomic():
+            return self.current_seq(), list_function()
+
+    def delta(self, list_name, list_function, since):
+        """ Returns the changes of list_name after since, or None when a full list must be sent instead """
+        with self.db.atomic():
+            seq = self.current_seq()
+            changes = self.since(list_name, since)
+            if changes is None or len(changes) > LIBRARY_DELTA_MAX_ITEMS:
+                return None
+            items = list_function(uuids=list(changes.keys())) if changes else list()
+        return self.split(since, seq, changes, items)
+
+    @staticmethod
+    def split(since, seq, changes, items):
+        """ Splits the changed items in added, changed and removed; items is the current list restricted to the changed uuids """
+        present = {uuid: item for item_dict in items for uuid, item in item_dict.items()}
+        added = list()
+        changed = list()
+        removed = list()
+        for uuid, kind in changes.items():
+            if uuid in present:
+                if kind == ADDED:
+                    added.append({uuid: present[uuid]})
+                else:
+                    changed.append({uuid: present[uuid]})
+            elif kind != ADDED:     # added and removed again after since, the client never had it
+                removed.append(uuid)
+        return {'since': since, 'seq': seq, 'added': added, 'changed': changed, 'removed': removed}
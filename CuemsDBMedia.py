@@ -10,6 +10,10 @@ from peewee import *
 from .CuemsUtils import StringSanitizer, CopyMoveVersioned, CuemsLibraryMaintenance, date_now_iso_utc
 from .CuemsDBModel import Project, Media, ProjectMedia
 from .CuemsErrors import *
+from .CuemsCache import invalidates, FILE_LIST, FILE_TRASH_LIST
+from .CuemsDBChanges import ADDED, CHANGED, REMOVED
+from .CuemsDBPages import CuemsDBPages
+from .CuemsDBBulk import bulk_move, run_parallel, BULK_OK
 from ..CTimecode import CTimecode
 from ..log import *
 
@@ -33,10 +37,12 @@ class MediaType(Enum):
 
 class CuemsDBMedia(StringSanitizer):
 
-    def __init__(self, library_path, tmp_path, db_connection):
+    def __init__(self, library_path, tmp_path, db_connection, list_cache, changes):
         self.library_path = library_path
         self.tmp_path = tmp_path
         self.db = db_connection
+        self.list_cache = list_cache
+        self.changes = changes
         self.media_path = os.path.join(self.library_path, MEDIA_FOLDER_NAME)
         self.trash_path = os.path.join(self.library_path, TRASH_FOLDER_NAME, MEDIA_FOLDER_NAME)
         self.thumbnail_path = os.path.join(self.media_path, THUMBNAIL_FOLDER_NAME)
@@ -44,12 +50,13 @@ class CuemsDBMedia(StringSanitizer):
         self.thumbnail_trash_path = os.path.join(self.trash_path, THUMBNAIL_FOLDER_NAME)
         self.waveform_trash_path = os.path.join(self.trash_path, WAVEFORM_FOLDER_NAME)
 
+    @invalidates(FILE_LIST)
     def new(self, tmp_file_path, filename):
         with self.db.atomic() as transaction:
             trash_state = False
             try:
                 dest_filename = None
-                dest_filename = CopyMoveVersioned.move(tmp_file_path, self.media_path, filename)
+                dest_filename = CopyMoveVersioned.rename(tmp_file_path, self.media_path, filename)
                 
                 try:
                     _type = self.get_type(dest_filename)
@@ -84,7 +91,9 @@ class CuemsDBMedia(StringSanitizer):
                     media_thumbnail_binary_data = None
 
                     
-                Media.create(uuid=uuid_module.uuid1(), name=dest_filename, unix_name=dest_filename, created=date_now_iso_utc(), modified=date_now_iso_utc(), duration=media_duration, media_type=_type.name, in_trash=False)
+                media_uuid = uuid_module.uuid1()
+                Media.create(uuid=media_uuid, name=dest_filename, unix_name=dest_filename, created=date_now_iso_utc(), modified=date_now_iso_utc(), duration=media_duration, media_type=_type.name, in_trash=False)
+                self.changes.record(FILE_LIST, [media_uuid], ADDED)
             except Exception as e:
                 logger.error("error: {} {} triying to move new file, rolling back database insert".format(type(e), e))
                 transaction.rollback()
@@ -105,7 +114,7 @@ class CuemsDBMedia(StringSanitizer):
 
                 raise e
 
-    def list(self):
+    def list(self, uuids=None):
         media_list = list()
 
         medias = (Media
@@ -116,13 +125,21 @@ class CuemsDBMedia(StringSanitizer):
          .join(Project, JOIN.LEFT_OUTER, on=(Project.uuid==ProjectMedia.project))  # Joins user -> tweet.
          .where(Media.in_trash==False)
          .group_by(Media.uuid))
+        if uuids is not None:
+            medias = medias.where(Media.uuid.in_(uuids))
         for media in medias:
             media_dict = {str(media.uuid): {'name': media.name, 'unix_name': media.unix_name, 'created': media.created, 'modified': media.modified,  'type': media.media_type, "in_projects": media.in_project_count, "in_trash_projects" : media.in_project_trash_count} }
             media_list.append(media_dict)
 
         return media_list
 
-    def list_trash(self):
+    def list_json(self):
+        return self.list_cache.get(FILE_LIST, lambda: self.changes.snapshot(self.list))
+
+    def list_delta(self, since):
+        return self.changes.delta(FILE_LIST, self.list, since)
+
+    def list_trash(self, uuids=None):
         media_list = list()
 
         medias = (Media
@@ -133,18 +150,47 @@ class CuemsDBMedia(StringSanitizer):
          .join(Project, JOIN.LEFT_OUTER, on=(Project.uuid==ProjectMedia.project))  # Joins user -> tweet.
          .where(Media.in_trash==True)
          .group_by(Media.uuid))
+        if uuids is not None:
+            medias = medias.where(Media.uuid.in_(uuids))
         for media in medias:
             media_dict = {str(media.uuid): {'name': media.name, 'unix_name': media.unix_name, 'created': media.created, 'modified': media.modified, 'type': media.media_type, "in_projects": media.in_project_count, "in_trash_projects" : media.in_project_trash_count} }
             media_list.append(media_dict)
 
         return media_list
 
+    def list_trash_json(self):
+        return self.list_cache.get(FILE_TRASH_LIST, lambda: self.changes.snapshot(self.list_trash))
+
+    def list_trash_delta(self, since):
+        return self.changes.delta(FILE_TRASH_LIST, self.list_trash, since)
+
+    def list_page(self, options, trash=False):
+        sort_fields = {'name': Media.name, 'created': Media.created, 'modified': Media.modified, 'type': Media.media_type, 'duration': Media.duration}
+        where = (Media.in_trash == trash)
+        filters = options.get('filter') or dict()
+        if filters.get('type'):
+            where &= (Media.media_type == filters['type'])
+        if filters.get('name_prefix'):
+            where &= CuemsDBPages.name_prefix(Media.name, filters['name_prefix'])
+        if filters.get('used') is not None:
+            used_medias = ProjectMedia.select(ProjectMedia.media)
+            where &= Media.uuid.in_(used_medias) if filters['used'] else Media.uuid.not_in(used_medias)
+
+        list_function = self.list_trash if trash else self.list
+        with self.db.atomic():
+            seq = self.changes.current_seq()
+            uuids, next_cursor = CuemsDBPages.page(Media, where, sort_fields, options)
+            items = CuemsDBPages.ordered(list_function(uuids=uuids), uuids)
+        return {'seq': seq, 'items': items, 'next_cursor': next_cursor}
+
+    @invalidates(FILE_LIST)
     def save(self, uuid, data):   #TODO: check uuid format
         try:
             media = Media.get((Media.uuid==uuid) & (Media.in_trash == False))
             with self.db.atomic() as transaction:
                 try:
                     media.update(name=StringSanitizer.sanitize_name(data['uuid']['name']), description=StringSanitizer.sanitize_text_size(data['uuid']['description']), modified=date_now_iso_utc()).execute()
+                    self.changes.record(FILE_LIST, [media.uuid], CHANGED)
                     return 'updated'
                 except Exception as e:
                     logger.error("error: {} {} triying to update  media data, rolling back database update".format(type(e), e))
@@ -204,6 +250,7 @@ class CuemsDBMedia(StringSanitizer):
             raise NonExistentItemError("item with uuid: {} does not exist".format(uuid))
 
         
+    @invalidates(FILE_LIST, FILE_TRASH_LIST)
     def delete(self, uuid):
         try:
             trash_state = False
@@ -236,6 +283,8 @@ class CuemsDBMedia(StringSanitizer):
                     dest_filename = CopyMoveVersioned.move(file_path, self.trash_path)
                     media.in_trash = True
                     media.save()
+                    self.changes.record(FILE_LIST, [media.uuid], REMOVED)
+                    self.changes.record(FILE_TRASH_LIST, [media.uuid], ADDED)
                     logger.debug('modifing instance in table: {}'.format(media))
                 except Exception as e:
                     logger.error("error: {} {}; triying to move file to trash, rolling back database".format(type(e), e))
@@ -265,6 +314,7 @@ class CuemsDBMedia(StringSanitizer):
         except DoesNotExist:
             raise NonExistentItemError("item with uuid: {} does not exist".format(uuid))
 
+    @invalidates(FILE_LIST, FILE_TRASH_LIST)
     def restore(self, uuid):
         try:
             trash_state = True
@@ -298,6 +348,8 @@ class CuemsDBMedia(StringSanitizer):
                     dest_filename = CopyMoveVersioned.move(file_path, self.media_path)
                     media_trash.in_trash = False
                     media_trash.save()
+                    self.changes.record(FILE_TRASH_LIST, [media_trash.uuid], REMOVED)
+                    self.changes.record(FILE_LIST, [media_trash.uuid], ADDED)
                     logger.debug('deleting instance from table: {}'.format(media_trash))
                 except Exception as e:
                     logger.error("error: {} {}; triying to move file to trash, rolling back database".format(type(e), e))
@@ -323,6 +375,7 @@ class CuemsDBMedia(StringSanitizer):
         except DoesNotExist:
             raise NonExistentItemError("item with uuid: {} does not exist".format(uuid))
 
+    @invalidates(FILE_TRASH_LIST)
     def delete_from_trash(self, uuid):
         try:
             trash_state=True
@@ -342,6 +395,7 @@ class CuemsDBMedia(StringSanitizer):
                             os.remove(file_waveform_path)
 
                     media.delete_instance(recursive=True)
+                    self.changes.record(FILE_TRASH_LIST, [media.uuid], REMOVED)
                     os.remove(file_path)
                     logger.debug('modifing instance in table: {}'.format(media))
                 except Exception as e:
@@ -352,6 +406,83 @@ class CuemsDBMedia(StringSanitizer):
         except DoesNotExist:
             raise NonExistentItemError("item with uuid: {} does not exist".format(uuid))
 
+    @invalidates(FILE_LIST, FILE_TRASH_LIST)
+    def delete_bulk(self, uuids):
+        return self.move_bulk(uuids, to_trash=True)
+
+    @invalidates(FILE_LIST, FILE_TRASH_LIST)
+    def restore_bulk(self, uuids):
+        return self.move_bulk(uuids, to_trash=False)
+
+    def move_bulk(self, uuids, to_trash):
+        """ Moves medias to or from the trash, their files in parallel and then one transaction for all of them.
+        Returns {uuid: 'OK' or error message}
+        """
+        results, medias = self.get_bulk(uuids, in_trash=not to_trash)
+
+        def update(moved):
+            with self.db.atomic():
+                Media.update(in_trash=to_trash).where(Media.uuid.in_(moved)).execute()
+                self.changes.record(FILE_LIST, moved, REMOVED if to_trash else ADDED)
+                self.changes.record(FILE_TRASH_LIST, moved, ADDED if to_trash else REMOVED)
+
+        failed = bulk_move(medias, lambda media: self.media_moves(media, to_trash), update)
+        for uuid in medias:
+            results[uuid] = failed.get(uuid, BULK_OK)
+        return results
+
+    @invalidates(FILE_TRASH_LIST)
+    def delete_from_trash_bulk(self, uuids):
+        """ Deletes medias from the trash in one transaction, then removes their files in parallel """
+        results, medias = self.get_bulk(uuids, in_trash=True)
+        if not medias:
+            return results
+        try:
+            with self.db.atomic():
+                for media in medias.values():
+                    media.delete_instance(recursive=True)
+                self.changes.record(FILE_TRASH_LIST, list(medias), REMOVED)
+        except Exception as e:
+            logger.error("error: {} {}; triying to delete files from trash, rolling back database".format(type(e), e))
+            for uuid in medias:
+                results[uuid] = str(e)
+            return results
+
+        for uuid in medias:
+            results[uuid] = BULK_OK
+        for uuid, e in run_parallel(lambda uuid: self.remove_media_files(medias[uuid]), list(medias)):
+            logger.error("error: {} {}; file {} deleted but its files could not be removed".format(type(e), e, uuid))
+            results[uuid] = 'deleted, but its files could not be removed: {}'.format(e)
+        return results
+
+    def empty_trash(self):
+        return self.delete_from_trash_bulk([str(media.uuid) for media in Media.select(Media.uuid).where(Media.in_trash == True)])
+
+    def get_bulk(self, uuids, in_trash):
+        """ Returns the results of the uuids that do not exist and {uuid: media} of the ones that do """
+        uuids = [str(uuid) for uuid in uuids]
+        medias = {str(media.uuid): media for media in Media.select().where(Media.uuid.in_(uuids) & (Media.in_trash == in_trash))}
+        results = {uuid: "item with uuid: {} does not exist".format(uuid) for uuid in uuids if uuid not in medias}
+        return results, medias
+
+    def media_moves(self, media, to_trash):
+        """ (orig path, dest folder, required) of every file of a media moving to or from the trash """
+        moves = [(self.get_thumbnail_path(media.unix_name, trash_state=not to_trash), self.thumbnail_trash_path if to_trash else self.thumbnail_path, False)]
+        if self.is_audio(media):
+            moves.append((self.get_waveform_path(media.unix_name, trash_state=not to_trash), self.waveform_trash_path if to_trash else self.waveform_path, False))
+        moves.append((self.get_file_path(media.unix_name, trash_state=not to_trash), self.trash_path if to_trash else self.media_path, True))
+        return moves
+
+    def remove_media_files(self, media):
+        file_thumbnail_path = self.get_thumbnail_path(media.unix_name, trash_state=True)
+        if os.path.exists(file_thumbnail_path):
+            os.remove(file_thumbnail_path)
+        if self.is_audio(media):
+            file_waveform_path = self.get_waveform_path(media.unix_name, trash_state=True)
+            if os.path.exists(file_waveform_path):
+                os.remove(file_waveform_path)
+        os.remove(self.get_file_path(media.unix_name, trash_state=True))
+
     def get_type(self, filename):
         movie_list = ('.mov', '.avi', '.mkv', '.mpg', '.mp4')
         audio_list = ('.aif', '.aiff', '.wav', '.mp3')
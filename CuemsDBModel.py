@@ -25,13 +25,14 @@ class Project(CuemsBaseModel):
     name = CharField(unique = True)
     unix_name = CharField(unique = True)
     description = TextField(null = True) #TODO: define maxsize
-    created = DateTimeField(default=date_now_iso_utc())
-    modified = DateTimeField(default=date_now_iso_utc())
+    created = DateTimeField(default=date_now_iso_utc(), index = True)
+    modified = DateTimeField(default=date_now_iso_utc(), index = True)
     in_trash = BooleanField(default=False)
+    revision = IntegerField(default=0)
 
     @staticmethod
     def all_fields():
-        return [Project.uuid, Project.name, Project.unix_name, Project.description, Project.created, Project.modified, Project.in_trash]
+        return [Project.uuid, Project.name, Project.unix_name, Project.description, Project.created, Project.modified, Project.in_trash, Project.revision]
 
 
     def medias(self):
@@ -50,10 +51,10 @@ class Media(CuemsBaseModel):
     name = CharField(unique = True)
     unix_name = CharField(unique = True)
     description = TextField(null = True) #TODO: define maxsize
-    created = DateTimeField(default=date_now_iso_utc())
-    modified = DateTimeField(default=date_now_iso_utc())
-    duration = CharField(null = True)
-    media_type = CharField()
+    created = DateTimeField(default=date_now_iso_utc(), index = True)
+    modified = DateTimeField(default=date_now_iso_utc(), index = True)
+    duration = CharField(null = True, index = True)
+    media_type = CharField(index = True)
     in_trash = BooleanField(default=False)
 
     @staticmethod
@@ -92,3 +93,13 @@ class ProjectMedia(CuemsBaseModel):
                     (Project.uuid == None))
                 .order_by(Media.created))
 
+
+
+class LibraryChange(CuemsBaseModel):
+    seq = AutoField()
+    list_name = CharField()
+    item = CharField()
+    kind = CharField()
+
+    class Meta:
+        indexes = ((('list_name', 'seq'), False),)
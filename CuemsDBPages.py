@@ -0,0 +1,87 @@
+import json
+import base64
+
+from ..log import *
+
+
+PAGE_DEFAULT_LIMIT = 200
+PAGE_MAX_LIMIT = 2000
+PAGE_OPTIONS = ('limit', 'cursor', 'sort', 'order', 'filter')
+
+
+class CuemsDBPages():
+    """ Keyset pagination: rows are ordered by (sort key, uuid) and the cursor holds the last pair sent,
+    so every page is an indexed range scan instead of an OFFSET over all the previous rows
+    """
+
+    @staticmethod
+    def is_page_request(options):
+        return isinstance(options, dict) and any(key in options for key in PAGE_OPTIONS)
+
+    @staticmethod
+    def encode_cursor(sort_value, uuid):
+        return base64.urlsafe_b64encode(json.dumps([sort_value, str(uuid)], default=str).encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            sort_value, uuid = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            return sort_value, uuid
+        except Exception:
+            raise ValueError('invalid cursor: {}'.format(cursor))
+
+    @staticmethod
+    def name_prefix(field, prefix):
+        # range instead of LIKE so the unique index on the name is used
+        return (field >= prefix) & (field < prefix + '\U0010ffff')
+
+    @staticmethod
+    def page(model, where, sort_fields, options):
+        """ Returns (uuids of the page in order, next page cursor or None) """
+        sort = options.get('sort', 'name')
+        if sort not in sort_fields:
+            raise ValueError('unsupported sort key: {}'.format(sort))
+        sort_expression = sort_fields[sort]
+        descending = options.get('order', 'asc') == 'desc'
+        limit = min(int(options.get('limit', PAGE_DEFAULT_LIMIT)), PAGE_MAX_LIMIT)
+        if limit < 1:
+            raise ValueError('limit must be positive')
+
+        query = model.select(model.uuid, sort_expression.alias('sort_value')).where(where)
+        if options.get('cursor'):
+            sort_value, last_uuid = CuemsDBPages.decode_cursor(options['cursor'])
+            query = query.where(CuemsDBPages.after(model, sort_expression, sort_value, last_uuid, descending))
+
+        if descending:
+            query = query.order_by(sort_expression.desc(), model.uuid.desc())
+        else:
+            query = query.order_by(sort_expression, model.uuid)
+
+        rows = list(query.limit(limit + 1))   # one more row tells if there is a next page
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = CuemsDBPages.encode_cursor(rows[-1].sort_value, rows[-1].uuid)
+        return [str(row.uuid) for row in rows], next_cursor
+
+    @staticmethod
+    def after(model, sort_expression, sort_value, last_uuid, descending):
+        """ Rows after the cursor. sqlite puts nulls first in ascending order and last in descending order,
+        nullable columns are compared as they are so their index is still used
+        """
+        if sort_value is None:
+            if descending:
+                return sort_expression.is_null() & (model.uuid < last_uuid)
+            return (sort_expression.is_null() & (model.uuid > last_uuid)) | sort_expression.is_null(False)
+        if descending:
+            after = (sort_expression < sort_value) | ((sort_expression == sort_value) & (model.uuid < last_uuid))
+            if getattr(sort_expression, 'null', False):
+                after |= sort_expression.is_null()
+            return after
+        return (sort_expression > sort_value) | ((sort_expression == sort_value) & (model.uuid > last_uuid))
+
+    @staticmethod
+    def ordered(items, uuids):
+        """ Puts the list entries (one {uuid: data} dict each) back in page order """
+        by_uuid = {uuid: item_dict for item_dict in items for uuid in item_dict}
+        return [by_uuid[uuid] for uuid in uuids if uuid in by_uuid]
@@ -1,31 +1,51 @@
 import os
+import copy
+import json
 import traceback
+import threading
 import uuid as uuid_module
 import shutil
+import tempfile
+from collections import OrderedDict
 from peewee import DoesNotExist, IntegrityError
 
 
 
 from .CuemsUtils import StringSanitizer, CopyMoveVersioned, CuemsLibraryMaintenance, date_now_iso_utc
-from ..DictParser import CuemsParser # do not import Media (File class) TODO: change this? name conflict Media (DB model) and Media ( Cue class)
-from ..XmlReaderWriter import XmlReader, XmlWriter
 from .CuemsErrors import *
 from .CuemsDBModel import Project, Media, ProjectMedia
+from .CuemsCache import invalidates, PROJECT_LIST, PROJECT_TRASH_LIST, FILE_LIST, FILE_TRASH_LIST
+from .CuemsDBChanges import ADDED, CHANGED, REMOVED
+from .CuemsDBPages import CuemsDBPages
+from .CuemsDBBulk import bulk_move, run_parallel, BULK_OK
+from .CuemsJsonPatch import apply_patch, patch_paths, make_patch
+from .CuemsProjectOutline import outline, cue_contents, cue_range
+from .CuemsProjectWorker import write_project, read_project, project_media, write_project_in_worker, read_project_in_worker
 from ..log import *
 
 SCRIPT_FILE_NAME = 'script.xml'
+SCRIPT_FILE_MODE = 0o644
 PROJECT_FOLDER_NAME = 'projects'
 TRASH_FOLDER_NAME = 'trash'
+WORKING_COPIES_MAX = 16 # projects kept in memory as base for patches
+PATCH_IMMUTABLE_KEYS = ('uuid', 'unix_name', 'created', 'modified')
 
 
 class CuemsDBProject(StringSanitizer):
 
-    def __init__(self, library_path, xsd_path, db_connection):
+    def __init__(self, library_path, schema_cache, db_connection, list_cache, changes, project_cache, revisions, process_pool=None):
         self.library_path = library_path
-        self.xsd_path = xsd_path
+        self.schema_cache = schema_cache
         self.db = db_connection
+        self.list_cache = list_cache
+        self.changes = changes
+        self.project_cache = project_cache
+        self.revisions = revisions
+        self.process_pool = process_pool  # parses and writes projects out of this process when set
         self.projects_path = os.path.join(self.library_path, PROJECT_FOLDER_NAME)
         self.trash_path = os.path.join(self.library_path, TRASH_FOLDER_NAME, PROJECT_FOLDER_NAME)
+        self.working_copies = OrderedDict()  # uuid: (revision, project dict in normal form) as last loaded or saved
+        self.working_copies_lock = threading.Lock()
     
     
     def get_project_unix_name(self, uuid):
@@ -38,58 +58,199 @@ class CuemsDBProject(StringSanitizer):
     def load(self, uuid):
         try:
             project = Project.get((Project.uuid==uuid) & (Project.in_trash == False))
-            return self.load_xml(project.unix_name)
+            data = self.load_xml(project.unix_name)
+            self.set_working_copy(uuid, project.revision, self.normal_form(data))
+            return project.revision, data
         except DoesNotExist:
             raise NonExistentItemError("item with uuid: {} does not exist".format(uuid))
 
-    def list(self):
+    def load_outline(self, uuid):
+        """ Returns the revision, the outline of the project and its top level cues """
+        revision, data = self.load(uuid)
+        return revision, outline(data), cue_contents(data)
+
+    def load_cues(self, uuid, revision, start, count):
+        """ Cue bodies of a revision of the project by position in its top level cue list, only while it is the current one """
+        data = self.get_working_copy(uuid, revision)
+        if data is None:
+            current_revision, data = self.load(uuid)
+            if current_revision != revision:
+                raise RevisionConflictError('project {} is at revision {}, cues asked for {}'.format(uuid, current_revision, revision), revision=current_revision)
+        return cue_range(data, start, count)
+
+    def list(self, uuids=None):
         project_list = list()
         projects = Project.select().where(Project.in_trash == False)
+        if uuids is not None:
+            projects = projects.where(Project.uuid.in_(uuids))
         for project in projects:
             project_dict = {str(project.uuid): {'name': project.name, 'unix_name': project.unix_name, 'created': project.created, 'modified': project.modified} }
             project_list.append(project_dict)
 
         return project_list
+
+    def list_json(self):
+        return self.list_cache.get(PROJECT_LIST, lambda: self.changes.snapshot(self.list))
+
+    def list_delta(self, since):
+        return self.changes.delta(PROJECT_LIST, self.list, since)
     
-    def list_trash(self):
+    def list_trash(self, uuids=None):
         project_trash_list = list()
         projects_trash = Project.select().where(Project.in_trash == True)
+        if uuids is not None:
+            projects_trash = projects_trash.where(Project.uuid.in_(uuids))
         for project in projects_trash:
             project_dict = {str(project.uuid): {'name': project.name, 'unix_name': project.unix_name, 'created': project.created, 'modified': project.modified} }
             project_trash_list.append(project_dict)
 
         return project_trash_list
 
-    def update(self, uuid, data):   #TODO: check uuid format
+    def list_trash_json(self):
+        return self.list_cache.get(PROJECT_TRASH_LIST, lambda: self.changes.snapshot(self.list_trash))
+
+    def list_trash_delta(self, since):
+        return self.changes.delta(PROJECT_TRASH_LIST, self.list_trash, since)
+
+    def list_page(self, options, trash=False):
+        sort_fields = {'name': Project.name, 'created': Project.created, 'modified': Project.modified}
+        where = (Project.in_trash == trash)
+        filters = options.get('filter') or dict()
+        if filters.get('name_prefix'):
+            where &= CuemsDBPages.name_prefix(Project.name, filters['name_prefix'])
+
+        list_function = self.list_trash if trash else self.list
+        with self.db.atomic():
+            seq = self.changes.current_seq()
+            uuids, next_cursor = CuemsDBPages.page(Project, where, sort_fields, options)
+            items = CuemsDBPages.ordered(list_function(uuids=uuids), uuids)
+        return {'seq': seq, 'items': items, 'next_cursor': next_cursor}
+
+    @invalidates(PROJECT_LIST, FILE_LIST, FILE_TRASH_LIST)
+    def update(self, uuid, data, base_revision=None):   #TODO: check uuid format
         try:
             project = Project.get((Project.uuid==uuid) & (Project.in_trash == False))
         except DoesNotExist:
             raise NonExistentItemError("item with uuid: {} does not exist".format(uuid))
+        if base_revision is not None and project.revision != base_revision:  # stale save, reject it before any parsing or writing
+            raise RevisionConflictError('project {} is at revision {}, save is based on {}'.format(uuid, project.revision, base_revision), revision=project.revision)
 
         try:
             del data['CuemsScript']['unix_name']
         except KeyError:
             pass
 
-        with self.db.atomic() as transaction:
+        previous_data = self.get_working_copy(uuid, project.revision)
+        now = date_now_iso_utc()
+        data['CuemsScript']['modified'] = now
+        # parse, validate and serialize before taking the write transaction, it is the slow part of a save
+        tmp_path, media_names = self.write_xml(project.unix_name, data)
+        try:
+            with self.db.atomic() as transaction:
+                revision = self.next_revision(project, base_revision)
+                try:
+                    project.name=StringSanitizer.sanitize_name(data['CuemsScript']['name'])
+                    project.modified=now
+                    project.description=StringSanitizer.sanitize_text_size(data['CuemsScript']['description'])
+                    project.save()
+                    self.update_media_relations(project, media_names)
+                    self.changes.record(PROJECT_LIST, [project.uuid], CHANGED)
+                    self.save_xml(project.unix_name, tmp_path)
+                except Exception as e:
+                    logger.error(traceback.format_exc()) # TODO: clean, only for debug
+                    logger.error("error: {} {} triying to update  project, rolling back database update".format(type(e), e))
+                    transaction.rollback()
+                    raise e
+        finally:
+            self.remove_tmp_xml(tmp_path)
+
+        data = self.normal_form(data)
+        self.set_working_copy(uuid, revision, data)
+        self.record_revision(project.unix_name, revision, data, previous_data)
+        # what changed from the previous revision, for the other editors; None if that revision is not in memory
+        diff = make_patch(previous_data, data) if previous_data is not None else None
+        return revision, diff
+
+    def patch(self, uuid, base_revision, operations):
+        """ Applies a json patch to the project at base_revision and saves the result as the next revision """
+        try:
+            project = Project.get((Project.uuid==uuid) & (Project.in_trash == False))
+        except DoesNotExist:
+            raise NonExistentItemError("item with uuid: {} does not exist".format(uuid))
+        if project.revision != base_revision:
+            raise RevisionConflictError('project {} is at revision {}, patch is based on {}'.format(uuid, project.revision, base_revision), revision=project.revision)
+
+        paths = patch_paths(operations)
+        for path in paths:  # only the script contents can be patched, the server owns its identity
+            if len(path) < 2 or path[0] != 'CuemsScript' or (len(path) == 2 and path[1] in PATCH_IMMUTABLE_KEYS):
+                raise PatchError('patch can not modify /{}'.format('/'.join(path)))
+
+        data = self.get_working_copy(uuid, base_revision)
+        if data is None:
+            data = self.load_xml(project.unix_name)
+        data = apply_patch(copy.deepcopy(data), operations)
+        return self.update(uuid, data, base_revision=base_revision)
+
+    def list_revisions(self, uuid):
+        """ Returns the current revision of the project and the stored ones """
+        try:
+            project = Project.get((Project.uuid==uuid) & (Project.in_trash == False))
+        except DoesNotExist:
+            raise NonExistentItemError("item with uuid: {} does not exist".format(uuid))
+        return project.revision, self.revisions.list(os.path.join(self.projects_path, project.unix_name))
+
+    def restore_revision(self, uuid, revision, base_revision):
+        """ Saves a stored revision of the project as its next revision """
+        unix_name = self.get_project_unix_name(uuid)
+        data = self.revisions.rebuild(os.path.join(self.projects_path, unix_name), revision)
+        data['CuemsScript']['uuid'] = str(uuid)
+        return self.update(uuid, data, base_revision=base_revision)
+
+    def record_revision(self, unix_name, revision, data, previous_data=None):
+        try:
+            self.revisions.record(os.path.join(self.projects_path, unix_name), revision, data, previous_data)
+        except Exception as e:  # the save is done, losing its history entry must not fail it
+            logger.error("error: {} {}; storing revision {} of project {}".format(type(e), e, revision, unix_name))
+
+    def next_revision(self, project, base_revision=None):
+        """ Moves the project to its next revision, only if nobody else did since base_revision (or since it was read) """
+        if base_revision is None:
+            base_revision = project.revision
+        rows = Project.update(revision=Project.revision + 1).where((Project.uuid == project.uuid) & (Project.revision == base_revision)).execute()
+        if rows == 0:
+            current_revision = Project.select(Project.revision).where(Project.uuid == project.uuid).scalar()
+            raise RevisionConflictError('project {} is at revision {}, not {}'.format(project.uuid, current_revision, base_revision), revision=current_revision)
+        project.revision = base_revision + 1
+        return project.revision
+
+    @staticmethod
+    def normal_form(data):
+        """ The project dict as the clients have it: json types and no unix_name, the same for a dict read
+        from the xml and one sent in a save, so diffs between them only hold the edits
+        """
+        data = json.loads(json.dumps(data))
+        data['CuemsScript'].pop('unix_name', None)
+        return data
+
+    def set_working_copy(self, uuid, revision, data):
+        with self.working_copies_lock:
+            self.working_copies[str(uuid)] = (revision, data)
+            self.working_copies.move_to_end(str(uuid))
+            while len(self.working_copies) > WORKING_COPIES_MAX:
+                self.working_copies.popitem(last=False)
+
+    def get_working_copy(self, uuid, revision):
+        with self.working_copies_lock:
             try:
-                project.name=StringSanitizer.sanitize_name(data['CuemsScript']['name'])
-                now = date_now_iso_utc()
-                data['CuemsScript']['modified'] = now
-                project.modified=now
-                project.description=StringSanitizer.sanitize_text_size(data['CuemsScript']['description'])
-                project.save()
-                project_object = CuemsParser(data).parse()
-                self.update_media_relations(project, project_object, data)
-                self.save_xml(project.unix_name, project_object)
-            except Exception as e:
-                logger.error(traceback.format_exc()) # TODO: clean, only for debug
-                logger.error("error: {} {} triying to update  project, rolling back database update".format(type(e), e))
-                transaction.rollback()
-                raise e
-            
+                copy_revision, data = self.working_copies[str(uuid)]
+            except KeyError:
+                return None
+        if copy_revision != revision:
+            return None
+        return data
         
 
+    @invalidates(PROJECT_LIST, FILE_LIST, FILE_TRASH_LIST)
     def new(self, data):
         try:
             unix_name = StringSanitizer.sanitize_dir_permit_increment(data['CuemsScript']['unix_name'])
@@ -106,9 +267,13 @@ class CuemsDBProject(StringSanitizer):
             try:
                 project = Project.create(uuid=project_uuid, unix_name=unix_name, name=StringSanitizer.sanitize_name(data['CuemsScript']['name']), description=StringSanitizer.sanitize_text_size(data['CuemsScript']['description']), created=now, modified=now)
                 os.mkdir(os.path.join(self.projects_path, unix_name))
-                project_object = CuemsParser(data).parse()
-                self.add_media_relations(project, project_object, data)
-                self.save_xml(unix_name, project_object)
+                tmp_path, media_names = self.write_xml(unix_name, data)
+                self.add_media_relations(project, media_names)
+                self.changes.record(PROJECT_LIST, [project_uuid], ADDED)
+                self.save_xml(unix_name, tmp_path)
+                data = self.normal_form(data)
+                self.set_working_copy(project_uuid, project.revision, data)
+                self.record_revision(unix_name, project.revision, data)
                 return project_uuid
             except IntegrityError as e:
                 transaction.rollback()
@@ -124,38 +289,40 @@ class CuemsDBProject(StringSanitizer):
                              
                 raise e
 
+    @invalidates(PROJECT_LIST, FILE_LIST, FILE_TRASH_LIST)
     def duplicate(self, uuid):
+        """ Returns the new project uuid and how many of its files were reflinked, hardlinked or copied """
         try:
             project = Project.get((Project.uuid==uuid) & (Project.in_trash == False))
-            with self.db.atomic() as transaction:
-                try:
-                    new_unix_name = None
-                    project_path = os.path.join(self.projects_path, project.unix_name)
-                    new_unix_name = CopyMoveVersioned.copy_dir(project_path, self.projects_path, project.unix_name)
-                    project.unix_name = new_unix_name
-                    new_uuid = str(uuid_module.uuid1())
-                    project.uuid = new_uuid
-                    project.name = project.name + ' - Copy'
-                    project.modified=date_now_iso_utc()
-                    project.save(force_insert=True)
-
-                    dup_project= Project.get(Project.uuid==new_uuid)
-                    data = self.load_xml(dup_project.unix_name)
-                    project_object = CuemsParser(data).parse()
-                    self.add_media_relations(dup_project, project_object, data)
-                    return new_uuid
-                except Exception as e:
-                    logger.error("error: {} {}; triying to duplicate  project, rolling back database update".format(type(e), e))
-                    transaction.rollback()
-                    if new_unix_name is None:  # if move or copy where not sucessfull with dont need to clean and can end here forwarding the exception, else continue cleaning and then forward the exception
-                        raise e
-                    if os.path.exists(os.path.join(self.projects_path, new_unix_name)):
-                        shutil.rmtree(os.path.join(self.projects_path, new_unix_name))
-                    raise e
-            
         except DoesNotExist:
             raise NonExistentItemError("item with uuid: {} does not exist".format(uuid))
 
+        # the copy is the slow part, do it before taking the write transaction
+        project_path = os.path.join(self.projects_path, project.unix_name)
+        new_unix_name, strategies = CopyMoveVersioned.clone_dir(project_path, self.projects_path, project.unix_name, mutable_names=(SCRIPT_FILE_NAME,))
+        with self.db.atomic() as transaction:
+            try:
+                project.unix_name = new_unix_name
+                new_uuid = str(uuid_module.uuid1())
+                project.uuid = new_uuid
+                project.name = project.name + ' - Copy'
+                project.modified=date_now_iso_utc()
+                project.save(force_insert=True)
+
+                dup_project= Project.get(Project.uuid==new_uuid)
+                data = self.load_xml(dup_project.unix_name)
+                self.add_media_relations(dup_project, self.media_names(data))
+                self.changes.record(PROJECT_LIST, [new_uuid], ADDED)
+                logger.info('project {} duplicated as {} ({})'.format(uuid, new_uuid, strategies))
+                return new_uuid, strategies
+            except Exception as e:
+                logger.error("error: {} {}; triying to duplicate  project, rolling back database update".format(type(e), e))
+                transaction.rollback()
+                if os.path.exists(os.path.join(self.projects_path, new_unix_name)):
+                    shutil.rmtree(os.path.join(self.projects_path, new_unix_name))
+                raise e
+
+    @invalidates(PROJECT_LIST, PROJECT_TRASH_LIST, FILE_LIST, FILE_TRASH_LIST)
     def delete(self, uuid):
         try:
             project = Project.get((Project.uuid==uuid) & (Project.in_trash == False))
@@ -166,6 +333,9 @@ class CuemsDBProject(StringSanitizer):
                     dest_filename = CopyMoveVersioned.move(file_path, self.trash_path, project.unix_name)
                     project.in_trash = True
                     project.save()
+                    self.changes.record(PROJECT_LIST, [project.uuid], REMOVED)
+                    self.changes.record(PROJECT_TRASH_LIST, [project.uuid], ADDED)
+                    self.record_media_changes(project.medias())
                     logger.debug('deleting instance from table: {}'.format(project))
                 except Exception as e:
                     logger.error("error: {} {}; triying to move file to trash, rolling back database".format(type(e), e))
@@ -179,6 +349,7 @@ class CuemsDBProject(StringSanitizer):
         except DoesNotExist:
             raise NonExistentItemError("item with uuid: {} does not exist".format(uuid))
     
+    @invalidates(PROJECT_LIST, PROJECT_TRASH_LIST, FILE_LIST, FILE_TRASH_LIST)
     def restore(self, uuid):
         try:
             project_trash = Project.get((Project.uuid==uuid) & (Project.in_trash == True))
@@ -190,6 +361,9 @@ class CuemsDBProject(StringSanitizer):
                     dest_filename = CopyMoveVersioned.move(project_path, self.projects_path, project_trash.unix_name)
                     project_trash.in_trash = False
                     project_trash.save()
+                    self.changes.record(PROJECT_TRASH_LIST, [project_trash.uuid], REMOVED)
+                    self.changes.record(PROJECT_LIST, [project_trash.uuid], ADDED)
+                    self.record_media_changes(project_trash.medias())
                     logger.debug('deleting instance from table: {}'.format(project_trash))
                 except Exception as e:
                     logger.error("error: {} {}; triying to move file to trash, rolling back database".format(type(e), e))
@@ -202,6 +376,7 @@ class CuemsDBProject(StringSanitizer):
         except DoesNotExist:
             raise NonExistentItemError("item with uuid: {} does not exist".format(uuid))
 
+    @invalidates(PROJECT_TRASH_LIST, FILE_LIST, FILE_TRASH_LIST)
     def delete_from_trash(self, uuid):
         try:
             project = Project.get((Project.uuid==uuid) & (Project.in_trash == True))
@@ -209,6 +384,8 @@ class CuemsDBProject(StringSanitizer):
             with self.db.atomic() as transaction:
                 try:
                     project_path = os.path.join(self.trash_path, project.unix_name)
+                    self.record_media_changes(project.medias())
+                    self.changes.record(PROJECT_TRASH_LIST, [project.uuid], REMOVED)
                     project.delete_instance(recursive=True)
                     shutil.rmtree(project_path)  #non empty dir, must use rmtree
                     logger.debug('deleting project from trash: {}'.format(project))
@@ -219,13 +396,82 @@ class CuemsDBProject(StringSanitizer):
         except DoesNotExist:
             raise NonExistentItemError("item with uuid: {} does not exist".format(uuid))
 
-    def add_media_relations(self, project, project_object, data):
-        media_dict = project_object.get_media()
-        for media_name, value in media_dict.items():
+    @invalidates(PROJECT_LIST, PROJECT_TRASH_LIST, FILE_LIST, FILE_TRASH_LIST)
+    def delete_bulk(self, uuids):
+        return self.move_bulk(uuids, to_trash=True)
+
+    @invalidates(PROJECT_LIST, PROJECT_TRASH_LIST, FILE_LIST, FILE_TRASH_LIST)
+    def restore_bulk(self, uuids):
+        return self.move_bulk(uuids, to_trash=False)
+
+    def move_bulk(self, uuids, to_trash):
+        """ Moves projects to or from the trash, their folders in parallel and then one transaction for all of them.
+        Returns {uuid: 'OK' or error message}
+        """
+        results, projects = self.get_bulk(uuids, in_trash=not to_trash)
+
+        def moves_of(project):
+            if to_trash:
+                return [(os.path.join(self.projects_path, project.unix_name), self.trash_path, True)]
+            return [(os.path.join(self.trash_path, project.unix_name), self.projects_path, True)]
+
+        def update(moved):
+            with self.db.atomic():
+                Project.update(in_trash=to_trash).where(Project.uuid.in_(moved)).execute()
+                self.changes.record(PROJECT_LIST, moved, REMOVED if to_trash else ADDED)
+                self.changes.record(PROJECT_TRASH_LIST, moved, ADDED if to_trash else REMOVED)
+                for uuid in moved:
+                    self.record_media_changes(projects[uuid].medias())
+
+        failed = bulk_move(projects, moves_of, update)
+        for uuid in projects:
+            results[uuid] = failed.get(uuid, BULK_OK)
+        return results
+
+    @invalidates(PROJECT_TRASH_LIST, FILE_LIST, FILE_TRASH_LIST)
+    def delete_from_trash_bulk(self, uuids):
+        """ Deletes projects from the trash in one transaction, then removes their folders in parallel """
+        results, projects = self.get_bulk(uuids, in_trash=True)
+        if not projects:
+            return results
+        try:
+            with self.db.atomic():
+                for project in projects.values():
+                    self.record_media_changes(project.medias())
+                    project.delete_instance(recursive=True)
+                self.changes.record(PROJECT_TRASH_LIST, list(projects), REMOVED)
+        except Exception as e:
+            logger.error("error: {} {}; triying to delete projects from trash, rolling back database".format(type(e), e))
+            for uuid in projects:
+                results[uuid] = str(e)
+            return results
+
+        for uuid in projects:
+            results[uuid] = BULK_OK
+        for uuid, e in run_parallel(lambda uuid: shutil.rmtree(os.path.join(self.trash_path, projects[uuid].unix_name)), list(projects)):
+            logger.error("error: {} {}; project {} deleted but its folder could not be removed".format(type(e), e, uuid))
+            results[uuid] = 'deleted, but its folder could not be removed: {}'.format(e)
+        return results
+
+    def empty_trash(self):
+        return self.delete_from_trash_bulk([str(project.uuid) for project in Project.select(Project.uuid).where(Project.in_trash == True)])
+
+    def get_bulk(self, uuids, in_trash):
+        """ Returns the results of the uuids that do not exist and {uuid: project} of the ones that do """
+        uuids = [str(uuid) for uuid in uuids]
+        projects = {str(project.uuid): project for project in Project.select().where(Project.uuid.in_(uuids) & (Project.in_trash == in_trash))}
+        results = {uuid: "item with uuid: {} does not exist".format(uuid) for uuid in uuids if uuid not in projects}
+        return results, projects
+
+    def add_media_relations(self, project, media_names):
+        added_medias = list()
+        for media_name in media_names:
             media = Media.get(Media.unix_name==media_name)
             ProjectMedia.create( project=project, media=media)    
+            added_medias.append(media)
+        self.record_media_changes(added_medias)
     
-    def update_media_relations(self, project, project_object, data):
+    def update_media_relations(self, project, media_names):
         old_media_query = project.medias()
         old_media_dict = dict()
         for media in old_media_query:
@@ -234,8 +480,7 @@ class CuemsDBProject(StringSanitizer):
 
         
         
-        media_dict = project_object.get_media()
-        media_list =list(media_dict.keys())
+        media_list = list(media_names)
         
         remove_set = set(old_media_list).difference(media_list)
         add_set = set(media_list).difference(old_media_list)
@@ -246,22 +491,62 @@ class CuemsDBProject(StringSanitizer):
         if remove_set:
             for media_unix_name in remove_set:
                 ProjectMedia.delete().where((ProjectMedia.project == project)&(ProjectMedia.media == old_media_dict[media_unix_name] )).execute() 
+            self.record_media_changes(media for media in old_media_query if media.unix_name in remove_set)
 
         if add_set:
+            added_medias = list()
             for media_unix_name in add_set:
-                media = Media.select(Media.uuid).where(Media.unix_name==media_unix_name).get()
+                media = Media.select(Media.uuid, Media.in_trash).where(Media.unix_name==media_unix_name).get()
                 ProjectMedia.create( project=project, media=media)
+                added_medias.append(media)
+            self.record_media_changes(added_medias)
+
+    def record_media_changes(self, medias):
+        # project counts of these medias changed, record it on the list each media is in
+        for media in medias:
+            self.changes.record(FILE_TRASH_LIST if media.in_trash else FILE_LIST, [media.uuid], CHANGED)
 
     
-    def save_xml(self, unix_name, project_object):
+    def write_xml(self, unix_name, data):
+        """ Parses and writes the project to a temporary file next to its script.xml, returns its path and the project media unix names """
+        fd, tmp_path = tempfile.mkstemp(prefix='.script.', suffix='.xml.tmp', dir=os.path.join(self.projects_path, unix_name))
+        os.close(fd)
+        os.chmod(tmp_path, SCRIPT_FILE_MODE)  # mkstemp makes it private, script.xml keeps the usual permissions
+        try:
+            if self.process_pool is None:
+                media_names = write_project(self.schema_cache, data, tmp_path)
+            else:
+                media_names = self.process_pool.submit(write_project_in_worker, data, tmp_path).result()
+        except Exception as e:
+            self.remove_tmp_xml(tmp_path)
+            raise e
+        return tmp_path, media_names
 
-        writer = XmlWriter(schema = self.xsd_path, xmlfile = (os.path.join(self.projects_path, unix_name, SCRIPT_FILE_NAME)))
-        writer.write_from_object(project_object)
+    def save_xml(self, unix_name, tmp_path):
+        """ Replaces script.xml with the file written by write_xml """
+        xml_path = os.path.join(self.projects_path, unix_name, SCRIPT_FILE_NAME)
+        os.replace(tmp_path, xml_path)
+        # the saved dict is in the client form, not what read_project gives, so the next load parses the file again
+        self.project_cache.invalidate(xml_path)
 
+    @staticmethod
+    def remove_tmp_xml(tmp_path):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
     def load_xml(self, unix_name):
-        reader = XmlReader(schema = self.xsd_path, xmlfile = (os.path.join(self.projects_path, unix_name, SCRIPT_FILE_NAME)))
-        return reader.read()
+        xml_path = os.path.join(self.projects_path, unix_name, SCRIPT_FILE_NAME)
+        if self.process_pool is None:
+            data = self.project_cache.get(xml_path, lambda: read_project(self.schema_cache, xml_path))
+        else:
+            data = self.project_cache.get(xml_path, lambda: self.process_pool.submit(read_project_in_worker, xml_path).result())
+        logger.debug('project cache {}'.format(self.project_cache.stats()))
+        return data
+
+    def media_names(self, data):
+        if self.process_pool is None:
+            return project_media(data)
+        return self.process_pool.submit(project_media, data).result()
 
             
 
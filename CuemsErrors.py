@@ -7,4 +7,10 @@ class NonExistentItemError(CuemsWsServerError):
 class NotTimeCodeError(CuemsWsServerError):
     pass
 class EngineError(CuemsWsServerError):
-    pass
\ No newline at end of file
+    pass
+class PatchError(CuemsWsServerError):
+    pass
+class RevisionConflictError(CuemsWsServerError):
+    def __init__(self, message, revision=None):
+        super().__init__(message)
+        self.revision = revision
@@ -0,0 +1,153 @@
+import copy
+
+from .CuemsErrors import PatchError
+
+
+# RFC 6902 json patch, applied to the plain dicts and lists of a project
+
+
+def parse_pointer(pointer):
+    if pointer == '':
+        return []
+    if not isinstance(pointer, str) or not pointer.startswith('/'):
+        raise PatchError('invalid json pointer: {}'.format(pointer))
+    return [token.replace('~1', '/').replace('~0', '~') for token in pointer[1:].split('/')]
+
+def list_index(token, length, allow_end=False):
+    if allow_end and token == '-':
+        return length
+    if not token.isdigit() or (len(token) > 1 and token[0] == '0'):
+        raise PatchError('invalid list index: {}'.format(token))
+    index = int(token)
+    if index > length or (index == length and not allow_end):
+        raise PatchError('list index out of range: {}'.format(token))
+    return index
+
+def get_child(container, token):
+    if isinstance(container, list):
+        return container[list_index(token, len(container))]
+    elif isinstance(container, dict):
+        try:
+            return container[token]
+        except KeyError:
+            raise PatchError('path does not exist: {}'.format(token))
+    raise PatchError('can not descend into a value at: {}'.format(token))
+
+def resolve(document, tokens):
+    for token in tokens:
+        document = get_child(document, token)
+    return document
+
+def add(document, tokens, value):
+    if not tokens:
+        return value
+    parent = resolve(document, tokens[:-1])
+    if isinstance(parent, list):
+        parent.insert(list_index(tokens[-1], len(parent), allow_end=True), value)
+    elif isinstance(parent, dict):
+        parent[tokens[-1]] = value
+    else:
+        raise PatchError('can not add to a value at: {}'.format(tokens[-1]))
+    return document
+
+def remove(document, tokens):
+    if not tokens:
+        raise PatchError('can not remove the whole document')
+    parent = resolve(document, tokens[:-1])
+    if isinstance(parent, list):
+        return parent.pop(list_index(tokens[-1], len(parent)))
+    elif isinstance(parent, dict):
+        try:
+            return parent.pop(tokens[-1])
+        except KeyError:
+            raise PatchError('path does not exist: {}'.format(tokens[-1]))
+    raise PatchError('can not remove from a value at: {}'.format(tokens[-1]))
+
+def apply_patch(document, operations):
+    """ Applies the operations in order and returns the patched document, document is modified in place """
+    if not isinstance(operations, list):
+        raise PatchError('a patch must be a list of operations')
+    for operation in operations:
+        try:
+            op = operation['op']
+            tokens = parse_pointer(operation['path'])
+            if op == 'add':
+                document = add(document, tokens, copy.deepcopy(operation['value']))
+            elif op == 'remove':
+                remove(document, tokens)
+            elif op == 'replace':
+                if tokens:
+                    resolve(document, tokens)   # must exist
+                    remove(document, tokens)
+                document = add(document, tokens, copy.deepcopy(operation['value']))
+            elif op == 'move':
+                from_tokens = parse_pointer(operation['from'])
+                if tokens[:len(from_tokens)] == from_tokens and tokens != from_tokens:
+                    raise PatchError('can not move a value into itself: {}'.format(operation['path']))
+                document = add(document, tokens, remove(document, from_tokens))
+            elif op == 'copy':
+                value = copy.deepcopy(resolve(document, parse_pointer(operation['from'])))
+                document = add(document, tokens, value)
+            elif op == 'test':
+                if resolve(document, tokens) != operation['value']:
+                    raise PatchError('test failed at: {}'.format(operation['path']))
+            else:
+                raise PatchError('unsupported patch operation: {}'.format(op))
+        except (KeyError, TypeError) as e:
+            raise PatchError('malformed patch operation {}: {}'.format(operation, e))
+    return document
+
+def patch_paths(operations):
+    """ Returns every path touched by the operations, as token lists """
+    paths = list()
+    for operation in operations:
+        paths.append(parse_pointer(operation['path']))
+        if 'from' in operation:
+            paths.append(parse_pointer(operation['from']))
+    return paths
+
+def escape_token(token):
+    return str(token).replace('~', '~0').replace('/', '~1')
+
+def make_patch(old, new, path=''):
+    """ Returns the operations turning old into new: dicts are compared key by key,
+    lists trimmed of their common start and end and then compared item by item
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        operations = list()
+        for key in old:
+            if key not in new:
+                operations.append({'op': 'remove', 'path': path + '/' + escape_token(key)})
+        for key, value in new.items():
+            if key not in old:
+                operations.append({'op': 'add', 'path': path + '/' + escape_token(key), 'value': value})
+            else:
+                operations.extend(make_patch(old[key], value, path + '/' + escape_token(key)))
+        return operations
+
+    if isinstance(old, list) and isinstance(new, list):
+        start = 0
+        while start < len(old) and start < len(new) and same(old[start], new[start]):
+            start += 1
+        old_end = len(old)
+        new_end = len(new)
+        while old_end > start and new_end > start and same(old[old_end - 1], new[new_end - 1]):
+            old_end -= 1
+            new_end -= 1
+
+        operations = list()
+        common = min(old_end, new_end) - start
+        for offset in range(common):
+            operations.extend(make_patch(old[start + offset], new[start + offset], path + '/' + str(start + offset)))
+        for index in range(old_end - 1, start + common - 1, -1):   # from the end, so indexes stay valid
+            operations.append({'op': 'remove', 'path': path + '/' + str(index)})
+        for index in range(start + common, new_end):
+            operations.append({'op': 'add', 'path': path + '/' + str(index), 'value': new[index]})
+        return operations
+
+    if same(old, new):
+        return []
+    return [{'op': 'replace', 'path': path, 'value': new}]
+
+def same(old, new):
+    return type(old) is type(new) and old == new
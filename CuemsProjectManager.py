@@ -1,5 +1,8 @@
 from peewee import *
+from playhouse.migrate import SqliteMigrator, migrate
 import os
+import multiprocessing
+import concurrent.futures
 from random import randint
 
 
@@ -8,7 +11,11 @@ import traceback
 
 from .CuemsDBMedia import CuemsDBMedia
 from .CuemsDBProject import CuemsDBProject
-from .CuemsDBModel import Project, Media, ProjectMedia, database
+from .CuemsDBModel import Project, Media, ProjectMedia, LibraryChange, database
+from .CuemsDBChanges import CuemsDBChanges
+from .CuemsProjectWorker import init_worker
+from .CuemsRevisions import CuemsRevisionStore, SNAPSHOT_EVERY, REVISIONS_KEPT, REVISIONS_MAX_BYTES
+from .CuemsCache import CuemsListCache, CuemsProjectCache, CuemsSchemaCache, PROJECT_CACHE_BYTES
 from .CuemsErrors import *
 from ..log import *
 
@@ -21,6 +28,7 @@ pewee_logger.setLevel(logging.INFO)
 
 
 SCRIPT_SCHEMA_FILE_PATH = '/etc/cuems/script.xsd' #TODO: get all this constants from config?
+PROJECT_PROCESS_WORKERS = 0 # processes parsing and writing projects, 0 does it in the server threads
 
 
 
@@ -38,8 +46,9 @@ class CuemsDBManager():
             raise e
 
         self.xsd_path = SCRIPT_SCHEMA_FILE_PATH
+        self.schema_cache = CuemsSchemaCache(self.xsd_path)
         self.db_path = os.path.join(self.library_path, self.db_name)
-        self.models = [Project, Media,  ProjectMedia]
+        self.models = [Project, Media,  ProjectMedia, LibraryChange]
         database.init(self.db_path)
         database.connect()
         logger.debug(f'database connected {database}, {self.db_name}')
@@ -50,10 +59,31 @@ class CuemsDBManager():
                 logger.warning(f'table "{model._meta.table_name	}" does not exist, creating') # pylint: disable=maybe-no-member
         # safe=True uses IF NOT EXIST on table create
         database.create_tables( self.models, safe=True) 
-        self.project = CuemsDBProject(self.library_path, self.xsd_path, database)
-        self.media = CuemsDBMedia(self.library_path, self.tmp_path, database)
- 
-
-
-
-
+        self.migrate_columns()
+        self.list_cache = CuemsListCache()
+        self.changes = CuemsDBChanges(database)
+        self.project_cache = CuemsProjectCache(settings_dict.get('project_cache_bytes', PROJECT_CACHE_BYTES))
+        self.revisions = CuemsRevisionStore(settings_dict.get('revisions_snapshot_every', SNAPSHOT_EVERY), settings_dict.get('revisions_kept', REVISIONS_KEPT), settings_dict.get('revisions_max_bytes', REVISIONS_MAX_BYTES))
+        self.process_pool = None
+        self.process_workers = settings_dict.get('project_process_workers', PROJECT_PROCESS_WORKERS)
+        if self.process_workers > 0:
+            # spawn, forking this process would copy its threads and the open database
+            self.process_pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.process_workers, mp_context=multiprocessing.get_context('spawn'), initializer=init_worker, initargs=(self.xsd_path,))
+            logger.info(f'parsing projects in {self.process_workers} processes')
+        self.project = CuemsDBProject(self.library_path, self.schema_cache, database, self.list_cache, self.changes, self.project_cache, self.revisions, self.process_pool)
+        self.media = CuemsDBMedia(self.library_path, self.tmp_path, database, self.list_cache, self.changes)
+
+    def migrate_columns(self):
+        # create_tables does not add new columns to tables created by older versions
+        migrator = SqliteMigrator(database)
+        for model in self.models:
+            columns = [column.name for column in database.get_columns(model._meta.table_name)] # pylint: disable=maybe-no-member
+            for field in model._meta.sorted_fields: # pylint: disable=maybe-no-member
+                if field.column_name not in columns:
+                    logger.warning(f'column "{field.column_name}" does not exist in table "{model._meta.table_name}", adding it') # pylint: disable=maybe-no-member
+                    migrate(migrator.add_column(model._meta.table_name, field.column_name, field)) # pylint: disable=maybe-no-member
+
+    def close(self):
+        if self.process_pool is not None:
+            self.process_pool.shutdown(wait=True)
+        database.close()
@@ -0,0 +1,47 @@
+from ..log import *
+
+
+CUE_LIST_KEY = 'CueList'
+CUE_CONTENTS_KEY = 'contents'
+# fields of each cue sent in a project outline, enough to draw the cue list before the cue bodies arrive
+OUTLINE_CUE_FIELDS = ('uuid', 'id', 'name', 'enabled', 'timecode', 'offset', 'prewait', 'postwait', 'post_go')
+CUE_CHUNK_SIZE = 100
+
+
+def cue_contents(data):
+    """ Top level cues of a project dict, each one a {cue class: cue dict} entry; empty list if it has none """
+    try:
+        contents = data['CuemsScript'][CUE_LIST_KEY][CUE_CONTENTS_KEY]
+    except (KeyError, TypeError):
+        return list()
+    return contents if isinstance(contents, list) else list()
+
+
+def outline_cue(cue):
+    outline = dict()
+    for cue_class, cue_dict in cue.items():
+        if isinstance(cue_dict, dict):
+            outline[cue_class] = {field: cue_dict[field] for field in OUTLINE_CUE_FIELDS if field in cue_dict}
+        else:
+            outline[cue_class] = cue_dict
+    return outline
+
+
+def outline(data):
+    """ The project dict with its top level cues reduced to OUTLINE_CUE_FIELDS, sharing everything else with data """
+    contents = cue_contents(data)
+    if not contents:
+        return data
+    script = dict(data['CuemsScript'])
+    cue_list = dict(script[CUE_LIST_KEY])
+    cue_list[CUE_CONTENTS_KEY] = [outline_cue(cue) for cue in contents]
+    script[CUE_LIST_KEY] = cue_list
+    project_outline = dict(data)
+    project_outline['CuemsScript'] = script
+    return project_outline
+
+
+def cue_range(data, start, count):
+    if start < 0 or count < 0:
+        raise ValueError('cue range start and count can not be negative')
+    return cue_contents(data)[start:start + count]
@@ -0,0 +1,40 @@
+import os
+
+from ..DictParser import CuemsParser # do not import Media (File class)
+from .CuemsCache import CuemsSchemaCache
+from ..log import *
+
+
+# project parsing, validation and serialization, run in the server threads or in the project process pool.
+# only plain data goes in and out (dicts, paths, media names), nothing here touches the database
+
+worker_schema_cache = None  # set in each pool process by init_worker
+
+
+def write_project(schema_cache, data, xml_path):
+    """ Parses the project dict and writes it validated to xml_path, returns the unix names of its medias """
+    project_object = CuemsParser(data).parse()
+    schema_cache.writer(xml_path).write_from_object(project_object)
+    return list(project_object.get_media().keys())
+
+
+def read_project(schema_cache, xml_path):
+    return schema_cache.reader(xml_path).read()
+
+
+def project_media(data):
+    return list(CuemsParser(data).parse().get_media().keys())
+
+
+def init_worker(xsd_path):
+    global worker_schema_cache
+    worker_schema_cache = CuemsSchemaCache(xsd_path)
+    logger.debug('project worker process {} ready'.format(os.getpid()))
+
+
+def write_project_in_worker(data, xml_path):
+    return write_project(worker_schema_cache, data, xml_path)
+
+
+def read_project_in_worker(xml_path):
+    return read_project(worker_schema_cache, xml_path)
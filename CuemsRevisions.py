@@ -0,0 +1,136 @@
+import os
+import re
+import gzip
+import json
+import hashlib
+import datetime
+import threading
+
+from .CuemsErrors import *
+from .CuemsJsonPatch import apply_patch, make_patch
+from .CuemsUtils import date_now_iso_utc
+from ..log import *
+
+
+REVISIONS_FOLDER_NAME = '.revisions'
+SNAPSHOT = 'snapshot'
+DELTA = 'delta'
+SNAPSHOT_EVERY = 20     # revisions between full snapshots, bounds the deltas applied to rebuild one
+REVISIONS_KEPT = 200
+REVISIONS_MAX_BYTES = 20 * 1024 * 1024  # per project
+REVISION_FILE_RE = re.compile(r'^(\d+)\.(snapshot|delta)\.json\.gz$')
+
+
+class CuemsRevisionStore():
+    """ Append only history of the saves of each project, in a folder inside the project folder.
+    Every revision is a gzipped json file, either the whole project (snapshot) or the json patch from the previous revision (delta).
+    A snapshot is written every SNAPSHOT_EVERY revisions and whenever the previous revision is not available,
+    or is not known to be the dict the delta would be made from.
+    """
+
+    def __init__(self, snapshot_every=SNAPSHOT_EVERY, kept=REVISIONS_KEPT, max_bytes=REVISIONS_MAX_BYTES):
+        self.snapshot_every = snapshot_every
+        self.kept = kept
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.recorded = dict()  # project path: (revision, digest) of the last dict this process stored
+
+    @staticmethod
+    def file_name(revision, kind):
+        return '{:010d}.{}.json.gz'.format(revision, kind)
+
+    def entries(self, project_path):
+        """ Stored revisions of a project, oldest first, as (revision, kind, file path) """
+        revisions_path = os.path.join(project_path, REVISIONS_FOLDER_NAME)
+        if not os.path.isdir(revisions_path):
+            return list()
+        entries = list()
+        for name in os.listdir(revisions_path):
+            match = REVISION_FILE_RE.match(name)
+            if match:
+                entries.append((int(match.group(1)), match.group(2), os.path.join(revisions_path, name)))
+        entries.sort()
+        return entries
+
+    @staticmethod
+    def digest(data):
+        try:
+            return hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+        except (TypeError, ValueError):     # not json, so not a dict read back from a revision either
+            return None
+
+    def record(self, project_path, revision, data, previous_data=None):
+        with self.lock:
+            entries = self.entries(project_path)
+            digest = self.digest(data)
+            if digest is None:
+                raise TypeError('project revision {} is not json serializable'.format(revision))
+            # a delta is only rebuilt right if it is made from the exact dict stored as the previous revision
+            previous_stored = (bool(entries) and entries[-1][0] == revision - 1 and previous_data is not None
+                               and self.recorded.get(project_path) == (revision - 1, self.digest(previous_data)))
+            if not previous_stored or revision % self.snapshot_every == 0:
+                kind, value = SNAPSHOT, data
+            else:
+                kind, value = DELTA, make_patch(previous_data, data)
+
+            revisions_path = os.path.join(project_path, REVISIONS_FOLDER_NAME)
+            os.makedirs(revisions_path, exist_ok=True)
+            file_path = os.path.join(revisions_path, self.file_name(revision, kind))
+            tmp_path = file_path + '.tmp'
+            with gzip.open(tmp_path, 'wt', encoding='utf-8') as revision_file:
+                json.dump({'revision': revision, 'saved': date_now_iso_utc(), 'value': value}, revision_file)
+            os.replace(tmp_path, file_path)
+            self.recorded[project_path] = (revision, digest)
+            logger.debug('project revision {} stored as {} in {}'.format(revision, kind, revisions_path))
+
+            self.prune(entries + [(revision, kind, file_path)])
+
+    def prune(self, entries):
+        """ Drops the oldest revisions over the retention limits, the oldest one kept is always a snapshot """
+        sizes = [os.path.getsize(entry[2]) for entry in entries]
+        cut = max(0, len(entries) - self.kept)
+        while cut < len(entries) - 1 and sum(sizes[cut:]) > self.max_bytes:
+            cut += 1
+        snapshots = [index for index, entry in enumerate(entries) if entry[1] == SNAPSHOT]
+        if not snapshots:
+            return
+        # start at the first snapshot from the cut, or at the newest one so the latest revisions can still be rebuilt
+        cut = next((index for index in snapshots if index >= cut), snapshots[-1])
+        for revision, kind, file_path in entries[:cut]:
+            os.remove(file_path)
+        if cut:
+            logger.debug('pruned {} project revisions up to {}'.format(cut, entries[cut - 1][0]))
+
+    @staticmethod
+    def read(file_path):
+        with gzip.open(file_path, 'rt', encoding='utf-8') as revision_file:
+            return json.load(revision_file)
+
+    def list(self, project_path):
+        revisions = list()
+        for revision, kind, file_path in self.entries(project_path):
+            stat = os.stat(file_path)
+            revisions.append({'revision': revision, 'kind': kind, 'size': stat.st_size, 'saved': datetime.datetime.utcfromtimestamp(stat.st_mtime).isoformat()})
+        return revisions
+
+    def rebuild(self, project_path, revision):
+        """ Project dict at revision, from the closest snapshot before it plus the deltas up to it """
+        with self.lock:    # no pruning while the files are read
+            entries = [entry for entry in self.entries(project_path) if entry[0] <= revision]
+            if not entries or entries[-1][0] != revision:
+                raise NonExistentItemError('revision {} is not stored'.format(revision))
+
+            start = len(entries) - 1
+            while start >= 0 and entries[start][1] != SNAPSHOT:
+                start -= 1
+            if start < 0:
+                raise NonExistentItemError('revision {} can not be rebuilt, no snapshot before it'.format(revision))
+
+            data = self.read(entries[start][2])['value']
+            expected = entries[start][0]
+            for stored_revision, kind, file_path in entries[start + 1:]:
+                expected += 1
+                if stored_revision != expected:
+                    raise NonExistentItemError('revision {} can not be rebuilt, revision {} is missing'.format(revision, expected))
+                data = apply_patch(data, self.read(file_path)['value'])
+        return data
@@ -1,43 +1,66 @@
 import os
 import json
+import struct
+import asyncio
 import aiofiles
-from hashlib import md5
-from random import randint
+import hashlib
 import websockets as ws
 
 
 from .CuemsUtils import StringSanitizer
 from .CuemsErrors import *
+from .CuemsUploadStore import UPLOAD_SYNC_BYTES
 from ..log import *
 
 
+# digests a client can ask for in the upload handshake, computed as the chunks are written
+UPLOAD_HASHES = {'md5': hashlib.md5, 'sha256': hashlib.sha256, 'blake2b': hashlib.blake2b}
+try:
+    import xxhash
+    UPLOAD_HASHES['xxh3_128'] = xxhash.xxh3_128
+except ImportError:
+    pass
+DEFAULT_UPLOAD_HASH = 'md5'
+UPLOAD_WINDOW_BYTES = 8 * 1024 * 1024   # bytes a client with credit flow control may send ahead of the disk writes
+UPLOAD_CREDIT_BATCHES = 4   # credits are given back in pieces of a quarter of the window, or when the writer catches up
+UPLOAD_MAX_TRANSFERS = 16   # transfers open at once in one connection
+UPLOAD_CONCURRENT_WRITES = 4    # chunks being written to disk at once by all the upload connections
+TRANSFER_HEADER = struct.Struct('<I')   # transfer id in front of every binary message of a multiplexed connection
 
-class CuemsUpload(StringSanitizer):
 
-    uploading = False
-    filename = None
-    tmp_filename = None
-    bytes_received = 0
-    filesize = 0
-    file_handle = None
+class CuemsUpload(StringSanitizer):
+    """ Upload connection. It carries one transfer or, when the client gives transfer ids in its upload
+    messages, several at once; their binary messages then start with the transfer id (TRANSFER_HEADER)
+    """
 
     def __init__(self, server, websocket):
         self.server = server
         self.websocket = websocket
         self.tmp_path = self.server.tmp_path
         self.media_path = self.server.db.media.media_path
-        
+        self.store = self.server.upload_store
+        self.window_bytes = self.server.settings_dict.get('upload_window_bytes', UPLOAD_WINDOW_BYTES)
+        self.max_transfers = self.server.settings_dict.get('upload_max_transfers', UPLOAD_MAX_TRANSFERS)
+        self.transfers = dict()     # transfer id (None without multiplexing): CuemsUploadTransfer
+        self.multiplexed = None     # set by the first upload message
+        self.tasks = set()
+
     async def message_handler(self):
-        while True:
-            try:
-                message = await self.websocket.recv()
-                if isinstance(message, str):
-                    await self.process_upload_message(message)
-                elif isinstance(message, bytes):
-                    await self.process_upload_packet(message)
-            except (ws.exceptions.ConnectionClosed, ws.exceptions.ConnectionClosedOK, ws.exceptions.ConnectionClosedError):
-                logger.debug('upload connection closed, exiting loop')
-                break
+        try:
+            while True:
+                try:
+                    message = await self.websocket.recv()
+                    if isinstance(message, str):
+                        await self.process_upload_message(message)
+                    elif isinstance(message, bytes):
+                        await self.process_upload_packet(message)
+                except (ws.exceptions.ConnectionClosed, ws.exceptions.ConnectionClosedOK, ws.exceptions.ConnectionClosedError):
+                    logger.debug('upload connection closed, exiting loop')
+                    break
+        finally:
+            for transfer in list(self.transfers.values()):
+                await transfer.suspend()
+            self.transfers.clear()
 
     async def message_sender(self, message):
         try:
@@ -45,92 +68,302 @@ class CuemsUpload(StringSanitizer):
         except (ws.exceptions.ConnectionClosed, ws.exceptions.ConnectionClosedOK, ws.exceptions.ConnectionClosedError) as e:
                 logger.debug(e)
 
+    async def send(self, transfer_id, message):
+        if transfer_id is not None:
+            message['transfer'] = transfer_id
+        await self.message_sender(json.dumps(message))
+
+    def run_task(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
     async def process_upload_message(self, message):
-        data = json.loads(message)
-        if 'action' not in data:
+        try:
+            data = json.loads(message)
+        except ValueError as e:
+            logger.info('malformed upload message: {}'.format(e))
+            return False
+        if not isinstance(data, dict) or 'action' not in data:
             return False
+        transfer_id = data.get('transfer')
         if data['action'] == 'upload':
-            await self.set_upload(file_info=data["value"])
+            await self.set_upload(data.get("value"), transfer_id)
+        elif data['action'] == 'finished':
+            transfer = self.transfers.pop(transfer_id, None) if transfer_id is None or isinstance(transfer_id, int) else None
+            if transfer is None:
+                await self.send(transfer_id, {'error' : 'unknown transfer {}'.format(transfer_id), 'fatal': True})
+                return False
+            # waits for its chunks to be written without holding the messages of the other transfers
+            self.run_task(transfer.finish(data.get("value")))
+
+    async def set_upload(self, file_info, transfer_id):
+        multiplexed = transfer_id is not None
+        if self.multiplexed is None:
+            self.multiplexed = multiplexed
+        if self.multiplexed != multiplexed or (multiplexed and not (isinstance(transfer_id, int) and 0 <= transfer_id <= 0xFFFFFFFF)):
+            await self.send(transfer_id, {'error' : 'every upload of a connection needs a transfer id (uint32), or none does', 'fatal': True})
+            return False
 
-    async def set_upload(self, file_info):
-        
         if not os.path.exists(self.media_path):
             logger.error("upload folder doenst exists")
-            await self.message_sender(json.dumps({'error' : 'upload folder doenst exist', 'fatal': True}))
+            await self.send(transfer_id, {'error' : 'upload folder doenst exist', 'fatal': True})
             return False
-        
-        self.filename = StringSanitizer.sanitize_file_name(file_info['name'])
-        self.tmp_filename = self.filename + '.tmp' + str(randint(100000, 999999))
-        logger.debug('tmp upload path: {}'.format(self.tmp_file_path()))
-
-        if not os.path.exists(self.tmp_file_path()):
-            self.filesize = file_info['size']
-            self.uploading = 'Ready'
-            await self.message_sender(json.dumps({"ready" : True}))
-        else:
-            await self.message_sender(json.dumps({'error' : 'file allready exists', 'fatal': True}))
-            logger.error("file allready exists")
+
+        previous = self.transfers.pop(transfer_id, None)
+        if previous is not None:
+            await previous.suspend()
+        if len(self.transfers) >= self.max_transfers:
+            await self.send(transfer_id, {'error' : 'too many transfers in this connection, max {}'.format(self.max_transfers), 'fatal': True})
+            return False
+
+        transfer = CuemsUploadTransfer(self, transfer_id)
+        if await transfer.start(file_info):
+            self.transfers[transfer_id] = transfer
 
     async def process_upload_packet(self, bin_data):
+        transfer_id = None
+        if self.multiplexed:
+            if len(bin_data) < TRANSFER_HEADER.size:
+                logger.error('upload packet without transfer header')
+                return False
+            (transfer_id,) = TRANSFER_HEADER.unpack_from(bin_data)
+            bin_data = memoryview(bin_data)[TRANSFER_HEADER.size:]
+        transfer = self.transfers.get(transfer_id)
+        if transfer is not None:
+            transfer.receive(bin_data)
+            if transfer.window is None:
+                # without credit nothing bounds the queue, the next message is read once the chunk is on disk
+                await transfer.chunks.join()
 
-        if self.uploading == 'Ready':
-            async with aiofiles.open(self.tmp_file_path(), mode='wb', loop=self.server.event_loop, executor=self.server.executor) as stream:
-                await stream.write(bin_data)
-                self.bytes_received += len(bin_data)
-                await self.message_sender(json.dumps({"ready" : True}))
+    async def discard(self, transfer):
+        """ Drops a failed transfer and its partial upload """
+        if self.transfers.get(transfer.transfer_id) is transfer:
+            del self.transfers[transfer.transfer_id]
+        await transfer.remove()
 
-                while True:
-                    message = await self.websocket.recv()
-                    if isinstance(message, bytes):
-                        await stream.write(message)
-                        self.bytes_received += len(message)
-                        await self.message_sender(json.dumps({"ready" : True}))
+
+class CuemsUploadTransfer():
+    """ One file being uploaded: its stored upload, open file, digest and the chunks waiting to be written """
+
+    def __init__(self, connection, transfer_id):
+        self.connection = connection
+        self.server = connection.server
+        self.store = connection.store
+        self.transfer_id = transfer_id
+        self.upload_info = None
+        self.filename = None
+        self.filesize = 0
+        self.bytes_received = 0
+        self.bytes_saved = 0
+        self.hasher = None
+        self.window = None      # credit window in bytes, None for a client waiting a ready after every chunk
+        self.in_flight = 0      # bytes received and not written yet
+        self.write_error = None
+        self.stream = None
+        self.chunks = asyncio.Queue()
+        self.writer = None
+
+    async def send(self, message):
+        await self.connection.send(self.transfer_id, message)
+
+    async def start(self, file_info):
+        try:
+            self.check_file_info(file_info)
+            if file_info.get('upload_id') is not None:     # reconnecting client, goes on from the saved offset
+                self.upload_info = await self.server.event_loop.run_in_executor(self.server.executor, self.store.resume, file_info['upload_id'])
+            else:
+                filename = StringSanitizer.sanitize_file_name(file_info['name'])
+                hash_name = self.choose_hash(file_info.get('hash', DEFAULT_UPLOAD_HASH))
+                self.upload_info = await self.server.event_loop.run_in_executor(self.server.executor, self.store.create, filename, file_info['size'], hash_name)
+        except (NonExistentItemError, FileIntegrityError) as e:
+            logger.info(e)
+            await self.send({'error' : str(e), 'fatal': True})
+            return False
+
+        try:
+            self.hasher = await self.server.event_loop.run_in_executor(self.server.executor, self.hash_received, self.upload_info)
+            self.filename = self.upload_info['filename']
+            self.filesize = self.upload_info['size']
+            self.bytes_received = self.bytes_saved = self.upload_info['offset']
+            logger.debug('tmp upload path: {}'.format(self.tmp_file_path()))
+            self.stream = await aiofiles.open(self.tmp_file_path(), mode='ab', loop=self.server.event_loop, executor=self.server.executor)
+        except Exception as e:
+            logger.error("error: {} {}".format(type(e), e))
+            # the store marked it as being sent, it must be resumable or collected again
+            self.store.release(self.upload_info['upload_id'])
+            self.upload_info = None
+            await self.send({'error' : 'error opening upload: {}'.format(e), 'fatal': True})
+            return False
+        self.writer = asyncio.ensure_future(self.write_chunks())
+
+        reply = {"ready" : True, "upload_id" : self.upload_info['upload_id'], "offset" : self.bytes_received, "hash" : self.upload_info.get('hash', DEFAULT_UPLOAD_HASH)}
+        if file_info.get('credit'):     # client streams within a window of credits instead of waiting a ready per chunk
+            self.window = self.connection.window_bytes
+            reply['credit'] = self.window
+        await self.send(reply)
+        return True
+
+    def receive(self, bin_data):
+        """ Queues a chunk for the writer without waiting, transfers with credit then do not hold the others of the connection """
+        if self.write_error is not None:
+            return
+        self.in_flight += len(bin_data)
+        if self.window is not None and self.in_flight > self.window:
+            self.abort(FileIntegrityError('upload {} sent {} bytes over its credit'.format(self.upload_info['upload_id'], self.in_flight - self.window)))
+            return
+        self.chunks.put_nowait(bin_data)
+
+    async def write_chunks(self):
+        """ Writes the queued chunks in order, answering each with a ready or giving their bytes back as credit once on disk """
+        credit = 0
+        while True:
+            chunk = await self.chunks.get()
+            pending = len(chunk)
+            try:
+                if self.write_error is None:
+                    async with self.server.upload_write_slots:  # server wide cap on concurrent disk writes
+                        await self.write_packet(chunk)
+                    # out of in_flight before it is given back, the client may spend it while the reply is being sent
+                    self.in_flight -= pending
+                    pending = 0
+                    if self.window is None:
+                        await self.send({"ready" : True})
                     else:
-                        data = json.loads(message)
-                        if 'action' not in data:
-                            return False
-                        if data['action'] == 'finished':
-                            await stream.flush()
-                            await stream.close()
-                            await self.upload_done(data["value"])
-                        break
+                        credit += len(chunk)
+                        if credit >= self.window // UPLOAD_CREDIT_BATCHES or self.chunks.empty():
+                            await self.send({"credit" : credit})
+                            credit = 0
+            except Exception as e:
+                self.abort(e)
+            finally:
+                self.in_flight -= pending
+                self.chunks.task_done()
+
+    def abort(self, error):
+        if self.write_error is not None:
+            return
+        logger.error("error: {} {}".format(type(error), error))
+        self.write_error = error
+        self.connection.run_task(self.send({'error' : str(error), 'fatal': True}))
+        self.connection.run_task(self.connection.discard(self))
+
+    async def write_packet(self, bin_data):
+        if self.bytes_received + len(bin_data) > self.filesize:
+            raise FileIntegrityError('upload {} is bigger than its size {}'.format(self.upload_info['upload_id'], self.filesize))
+        # the digest is updated in an executor thread while aiofiles writes the chunk, hashlib releases the GIL for big buffers
+        await asyncio.gather(self.stream.write(bin_data), self.server.event_loop.run_in_executor(self.server.executor, self.hasher.update, bin_data))
+        self.bytes_received += len(bin_data)
+        if self.bytes_received - self.bytes_saved >= UPLOAD_SYNC_BYTES:
+            await self.stream.flush()
+            await self.save_offset()
+
+    async def save_offset(self):
+        self.upload_info['offset'] = self.bytes_received
+        await self.server.event_loop.run_in_executor(self.server.executor, self.store.save, self.upload_info)
+        self.bytes_saved = self.bytes_received
+
+    async def close_stream(self):
+        """ Waits for the received chunks to be written, then closes the file """
+        await self.chunks.join()
+        if self.writer is not None:
+            self.writer.cancel()
+            self.writer = None
+        if self.stream is not None:
+            await self.stream.close()
+            self.stream = None
+
+    async def suspend(self):
+        """ Keeps the partial upload to be resumed later """
+        if self.upload_info is None:
+            return
+        try:
+            await self.close_stream()
+            await self.save_offset()
+            logger.debug('upload {} suspended at {} bytes'.format(self.upload_info['upload_id'], self.bytes_received))
+        except Exception as e:
+            logger.error("error: {} {}".format(type(e), e))
+        finally:
+            self.store.release(self.upload_info['upload_id'])
+            self.upload_info = None
 
+    async def remove(self):
+        if self.upload_info is None:
+            return
+        upload_id = self.upload_info['upload_id']
+        self.upload_info = None
+        try:
+            await self.close_stream()
+        finally:
+            await self.server.event_loop.run_in_executor(self.server.executor, self.store.remove, upload_id)
 
-    async def upload_done(self, received_md5):
+    async def finish(self, received_digest):
+        if self.upload_info is None:
+            return
+        upload_id = self.upload_info['upload_id']
         try:
-            
-            await self.server.event_loop.run_in_executor(self.server.executor, self.check_file_integrity,  self.tmp_file_path(), received_md5)
-            
+            await self.close_stream()
+            if self.write_error is not None:
+                raise self.write_error
+            if self.bytes_received != self.filesize:
+                raise FileIntegrityError('upload {} incomplete, {} of {} bytes'.format(upload_id, self.bytes_received, self.filesize))
+
+            self.check_file_integrity(received_digest)
+
             await self.server.event_loop.run_in_executor(self.server.executor, self.server.db.media.new,  self.tmp_file_path(), self.filename)
-            self.tmp_filename = None
             logger.debug('upload completed')
-            await self.message_sender(json.dumps({"close" : True}))
+            await self.send({"close" : True})
             await self.server.notify_others_list_changes(None, "file_list")
         except Exception as e:
             logger.error("error: {} {}".format(type(e), e))
-            await self.message_sender(json.dumps({'error' : 'error saving file', 'fatal': True}))
-
-    def check_file_integrity(self, path, original_md5):
-
-        hash_md5 = md5()
-        with open(path, "rb") as file_to_check:
-            for chunk in iter(lambda: file_to_check.read(65536), b""):
-                hash_md5.update(chunk)
-        
-        returned_md5 = hash_md5.hexdigest()
-        if original_md5 != returned_md5:
-            raise FileIntegrityError('MD5 mistmatch')
-            
+            await self.send({'error' : 'error saving file', 'fatal': True})
+        finally:
+            self.upload_info = None
+            await self.server.event_loop.run_in_executor(self.server.executor, self.store.remove, upload_id)
+
+    def check_file_integrity(self, original_digest):
+        # the digest was computed while the chunks were written, no need to read the file again
+        if not isinstance(original_digest, str) or original_digest.lower() != self.hasher.hexdigest():
+            raise FileIntegrityError('{} mistmatch'.format(self.upload_info.get('hash', DEFAULT_UPLOAD_HASH)))
         return True
 
-    def tmp_file_path(self):
-        if not self.tmp_filename is None:
-            return os.path.join(self.tmp_path, self.tmp_filename)
+    @staticmethod
+    def check_file_info(file_info):
+        """ Rejects a malformed upload value, only for this transfer, before anything is stored """
+        if not isinstance(file_info, dict):
+            raise FileIntegrityError('upload value must be an object')
+        if file_info.get('upload_id') is not None:     # resume, the store checks the id
+            return
+        if not isinstance(file_info.get('name'), str) or not file_info['name']:
+            raise FileIntegrityError('upload name must be a non empty string')
+        size = file_info.get('size')
+        if not isinstance(size, int) or isinstance(size, bool) or size < 0:
+            raise FileIntegrityError('upload size must be a non negative integer, not {}'.format(size))
 
-    def __del__(self):
-        try:
-            if self.tmp_file_path():
-                os.remove(self.tmp_file_path())  # TODO: change to pathlib ?  
-                logger.debug('cleaning tmp upload file on object destruction: ({})'.format(self.tmp_file_path()))
-        except FileNotFoundError:
-            pass
+    @staticmethod
+    def choose_hash(requested):
+        """ First supported of the digest name or list of names the client asked for """
+        if not isinstance(requested, (str, list)):
+            raise FileIntegrityError('upload hash must be a name or a list of names, not {}'.format(requested))
+        for hash_name in ([requested] if isinstance(requested, str) else requested):
+            if isinstance(hash_name, str) and hash_name in UPLOAD_HASHES:
+                return hash_name
+        raise FileIntegrityError('unsupported hash {}, supported: {}'.format(requested, list(UPLOAD_HASHES)))
+
+    def hash_received(self, upload_info):
+        """ New digest of the upload, fed with the bytes already received when it is resumed """
+        hasher = UPLOAD_HASHES[upload_info.get('hash', DEFAULT_UPLOAD_HASH)]()
+        if upload_info['offset']:
+            with open(self.store.data_path(upload_info['upload_id']), 'rb') as received:
+                remaining = upload_info['offset']
+                while remaining:
+                    chunk = received.read(min(remaining, 1024 * 1024))
+                    if not chunk:
+                        break
+                    hasher.update(chunk)
+                    remaining -= len(chunk)
+        return hasher
+
+    def tmp_file_path(self):
+        if self.upload_info is not None:
+            return self.store.data_path(self.upload_info['upload_id'])
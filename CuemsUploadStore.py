@@ -0,0 +1,130 @@
+import os
+import re
+import json
+import time
+import threading
+import uuid as uuid_module
+
+from .CuemsErrors import *
+from ..log import *
+
+
+UPLOAD_DATA_SUFFIX = '.upload'
+UPLOAD_INFO_SUFFIX = '.upload.json'
+UPLOAD_MAX_AGE = 24 * 60 * 60               # seconds without receiving data before a partial upload is removed
+UPLOAD_MAX_BYTES = 50 * 1024 * 1024 * 1024  # partial uploads kept, the oldest are removed first
+UPLOAD_SYNC_BYTES = 16 * 1024 * 1024        # received bytes between offset saves, at most this is sent again on resume
+UPLOAD_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+UPLOAD_STAGING_FOLDER_NAME = '.uploads'
+
+
+class CuemsUploadStore():
+    """ Partial uploads kept in a staging folder, so an interrupted upload can go on from where it stopped.
+    Each upload is a data file plus a json file with its name, size and the bytes received (offset).
+    Blocking, call it from the executor.
+    """
+
+    def __init__(self, tmp_path, media_path, max_age=UPLOAD_MAX_AGE, max_bytes=UPLOAD_MAX_BYTES):
+        self.upload_path = self.staging_path(tmp_path, media_path)
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        self.active = set()     # uploads with a connection sending them
+
+    @staticmethod
+    def staging_path(tmp_path, media_path):
+        """ tmp_path, or a hidden folder in media_path when they are on different filesystems,
+        so a finished upload is renamed into the media folder instead of copied
+        """
+        try:
+            if os.stat(tmp_path).st_dev == os.stat(media_path).st_dev:
+                return tmp_path
+            staging_path = os.path.join(media_path, UPLOAD_STAGING_FOLDER_NAME)
+            os.makedirs(staging_path, exist_ok=True)
+        except OSError as e:
+            logger.warning('can not stage uploads in the media filesystem, using {}: {}'.format(tmp_path, e))
+            return tmp_path
+        logger.info('{} is not in the media filesystem, staging uploads in {}'.format(tmp_path, staging_path))
+        return staging_path
+
+    def data_path(self, upload_id):
+        return os.path.join(self.upload_path, upload_id + UPLOAD_DATA_SUFFIX)
+
+    def info_path(self, upload_id):
+        return os.path.join(self.upload_path, upload_id + UPLOAD_INFO_SUFFIX)
+
+    def create(self, filename, size, hash_name):
+        self.collect_garbage()
+        now = time.time()
+        info = {'upload_id': uuid_module.uuid4().hex, 'filename': filename, 'size': size, 'hash': hash_name, 'offset': 0, 'created': now, 'updated': now}
+        with self.lock:
+            self.active.add(info['upload_id'])
+        open(self.data_path(info['upload_id']), 'wb').close()
+        self.save(info)
+        return info
+
+    def resume(self, upload_id):
+        """ Returns the info of a partial upload, its data file cut to the last saved offset """
+        if not isinstance(upload_id, str) or not UPLOAD_ID_RE.match(upload_id):
+            raise NonExistentItemError('upload {} does not exist'.format(upload_id))
+        with self.lock:
+            if upload_id in self.active:
+                raise FileIntegrityError('upload {} is being sent by another connection'.format(upload_id))
+            try:
+                with open(self.info_path(upload_id), 'r') as info_file:
+                    info = json.load(info_file)
+                data_size = os.path.getsize(self.data_path(upload_id))
+            except FileNotFoundError:
+                raise NonExistentItemError('upload {} does not exist'.format(upload_id))
+            self.active.add(upload_id)
+
+        # bytes written after the last offset save are not trusted, they are asked again
+        info['offset'] = min(info['offset'], data_size)
+        os.truncate(self.data_path(upload_id), info['offset'])
+        logger.debug('resuming upload {} of {} at {} bytes'.format(upload_id, info['filename'], info['offset']))
+        return info
+
+    def save(self, info):
+        info['updated'] = time.time()
+        info_path = self.info_path(info['upload_id'])
+        with open(info_path + '.tmp', 'w') as info_file:
+            json.dump(info, info_file)
+        os.replace(info_path + '.tmp', info_path)
+
+    def release(self, upload_id):
+        with self.lock:
+            self.active.discard(upload_id)
+
+    def remove(self, upload_id):
+        for path in (self.data_path(upload_id), self.info_path(upload_id)):
+            if os.path.exists(path):
+                os.remove(path)
+        self.release(upload_id)
+
+    def collect_garbage(self):
+        """ Removes partial uploads nobody is sending, older than max_age or, oldest first, over max_bytes in total """
+        uploads = list()
+        for name in os.listdir(self.upload_path):
+            if not name.endswith(UPLOAD_INFO_SUFFIX):
+                continue
+            upload_id = name[:-len(UPLOAD_INFO_SUFFIX)]
+            try:
+                with open(self.info_path(upload_id), 'r') as info_file:
+                    updated = json.load(info_file)['updated']
+                size = os.path.getsize(self.data_path(upload_id)) if os.path.exists(self.data_path(upload_id)) else 0
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning('unreadable upload {}, removing it: {}'.format(upload_id, e))
+                updated, size = 0, 0
+            uploads.append((updated, upload_id, size))
+
+        uploads.sort()
+        total = sum(upload[2] for upload in uploads)
+        now = time.time()
+        for updated, upload_id, size in uploads:
+            with self.lock:     # not resumed while it is being removed
+                if upload_id in self.active:
+                    continue
+                if now - updated > self.max_age or total > self.max_bytes:
+                    logger.info('removing abandoned upload {} ({} bytes)'.format(upload_id, size))
+                    self.remove(upload_id)
+                    total -= size
@@ -1,4 +1,7 @@
 import os
+import errno
+import fcntl
+import ctypes
 import shutil
 import datetime
 import uuid as uuid_module
@@ -6,10 +9,35 @@ from ..log import logger
 
 
 
+FICLONE = 0x40049409    # linux ioctl, shares the data blocks of a file on copy on write filesystems (btrfs, xfs)
+REFLINK = 'reflink'
+HARDLINK = 'hardlink'
+COPY = 'copy'
+AT_FDCWD = -100
+RENAME_NOREPLACE = 1    # renameat2 flag, fails with EEXIST instead of replacing the destination
+try:
+    _renameat2 = ctypes.CDLL(None, use_errno=True).renameat2    # glibc 2.28+
+    _renameat2.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint)
+except (AttributeError, OSError):
+    _renameat2 = None
+
+
 def date_now_iso_utc():
     return datetime.datetime.utcnow().isoformat()
 
 
+def rename_noreplace(src, dst):
+    """ Atomic rename that never replaces dst, FileExistsError if it exists. Same filesystem only, EXDEV otherwise """
+    if _renameat2 is not None:
+        if _renameat2(AT_FDCWD, os.fsencode(src), AT_FDCWD, os.fsencode(dst), RENAME_NOREPLACE) == 0:
+            return
+        err = ctypes.get_errno()
+        if err not in (errno.ENOSYS, errno.EINVAL):    # old kernel or a filesystem without the flag
+            raise OSError(err, os.strerror(err), src, None, dst)
+    os.link(src, dst)   # link does not replace either
+    os.unlink(src)
+
+
 class StringSanitizer():
 
     @staticmethod
@@ -75,6 +103,30 @@ class CopyMoveVersioned():
                 continue    
         return dest_filename
 
+    @staticmethod
+    def rename(orig_path, dest_path, dest_filename=None):
+        """ Like move, but with an atomic rename that can not replace a file created meanwhile.
+        Falls back to move when orig_path is on another filesystem or hardlinks are not supported
+        """
+        i = 0
+        if dest_filename is None:
+            dest_filename = os.path.basename(orig_path)
+
+        (base, ext) = os.path.splitext(dest_filename)
+
+        while True:
+            try:
+                rename_noreplace(orig_path, os.path.join(dest_path, dest_filename))
+                logger.debug('renamed file to: {}'.format(os.path.join(dest_path, dest_filename)))
+                return dest_filename
+            except FileExistsError:
+                i += 1
+                dest_filename = base + "-{:03d}".format(i) + ext
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP):
+                    raise e
+                return CopyMoveVersioned.move(orig_path, dest_path, dest_filename)
+
     @staticmethod
     def copy_dir(orig_path, dest_path, dest_dirname):
         i = 0
@@ -90,6 +142,61 @@ class CopyMoveVersioned():
                 continue    
         return dest_dirname
 
+    @staticmethod
+    def clone_dir(orig_path, dest_path, dest_dirname, mutable_names=()):
+        """ Like copy_dir, but sharing data with the original where possible: reflink clones first, then hardlinks
+        for files not in mutable_names (they are never written in place), then plain copies.
+        Returns the new dir name and how many files were copied with each strategy
+        """
+        i = 0
+        orig_name = dest_dirname
+        while True:
+            try:
+                os.mkdir(os.path.join(dest_path, dest_dirname))    # reserves the name
+                break
+            except FileExistsError:
+                i += 1
+                dest_dirname = orig_name + "-{:03d}".format(i)
+
+        strategies = {REFLINK: 0, HARDLINK: 0, COPY: 0}
+        def clone_file(src, dst):
+            strategy = CopyMoveVersioned.clone_file(src, dst, os.path.basename(src) not in mutable_names)
+            strategies[strategy] += 1
+            return dst
+
+        logger.debug('cloning dir to: {}'.format(os.path.join(dest_path, dest_dirname)))
+        try:
+            shutil.copytree(orig_path, os.path.join(dest_path, dest_dirname), copy_function=clone_file, dirs_exist_ok=True)
+        except Exception as e:
+            shutil.rmtree(os.path.join(dest_path, dest_dirname), ignore_errors=True)
+            raise e
+        logger.debug('dir cloned with {}'.format(strategies))
+        return dest_dirname, strategies
+
+    @staticmethod
+    def clone_file(src, dst, immutable=False):
+        try:
+            with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+            shutil.copystat(src, dst)
+            return REFLINK
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EBADF):
+                raise e
+            if os.path.exists(dst):
+                os.remove(dst)
+
+        if immutable:
+            try:
+                os.link(src, dst)
+                return HARDLINK
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP):
+                    raise e
+
+        shutil.copy2(src, dst)
+        return COPY
+
 class CuemsLibraryMaintenance():
     def __init__(self, library_path):
         self.library_path = library_path
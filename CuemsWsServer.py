@@ -9,12 +9,17 @@ from random import randint  #TODO: clean unused
 from hashlib import md5
 import uuid as uuid_module
 import re
+import time
+import threading
+import queue
 
 from ..log import *
 
 from .CuemsProjectManager import CuemsDBManager
-from .CuemsWsUser import CuemsWsUser
-from .CuemsUpload import CuemsUpload
+from .CuemsWsUser import CuemsWsUser, FAST_LANE, HEAVY_LANE
+from .CuemsUpload import CuemsUpload, UPLOAD_CONCURRENT_WRITES
+from .CuemsUploadStore import CuemsUploadStore, UPLOAD_MAX_AGE, UPLOAD_MAX_BYTES
+from .CuemsDBMedia import MEDIA_FOLDER_NAME
 from .CuemsErrors import *
 
 
@@ -34,14 +39,32 @@ logger_asyncio.setLevel(logging.WARNING)  # asyncio debug level
 logger_ws = logging.getLogger('websockets')
 logger_ws.setLevel(logging.WARNING)  # websockets debug level,  in debug prints all frames, also binary frames! 
 
+ENGINE_DEFAULT_TIMEOUT = 10 # seconds waiting an engine reply when the command has no specific timeout
+ENGINE_TIMEOUTS = {'project_ready': 10, 'project_deploy': 30, 'hw_discovery': 30}
+ENGINE_ORPHAN_TTL = 60 # seconds an unclaimed engine reply is kept before being dropped
+ENGINE_QUEUE_BATCH_SIZE = 64 # max engine messages handed to the event loop per reader wakeup
+ENGINE_QUEUE_POLL_TIMEOUT = 0.5 # seconds the reader blocks on the queue before checking if it must stop
+EXECUTOR_WORKERS = 5
+NOTIFY_COALESCE_WINDOW = 0.1 # seconds list and project update notifications are held to merge duplicates, 0 disables it
+LIST_TOPICS = ('project_list', 'project_trash_list', 'file_list', 'file_trash_list')
+DEFAULT_TOPICS = (*LIST_TOPICS, 'users', 'engine') # subscribed on connection, so clients that never subscribe get every event
+PROJECT_TOPIC_PREFIX = 'project:'
+OUTGOING_QUEUE_LIMIT = 256 # messages waiting to be sent to a user before it is considered too slow and dropped
+FAST_LANE_WORKERS = 4 # per connection concurrent cheap reads
+HEAVY_LANE_WORKERS = 2 # per connection concurrent writes, heavy reads and engine commands
+
 
 class CuemsWsServer():
     
     def __init__(self, engine_queue, editor_queue, settings_dict, mappings_dict ):
         self.editor_queue = editor_queue
         self.engine_queue = engine_queue
-        self.engine_messages = list()
+        self.engine_messages = dict()   # orphaned engine replies, action_uuid: (arrival time, message)
+        self.engine_waiters = dict()    # pending engine commands, action_uuid: future
+        self.engine_queue_stats = {'received': 0, 'messages_per_second': 0, 'queue_depth': 0}
+        self.engine_reader_stop = threading.Event()
         self.users = dict()
+        self.topics = dict()    # topic: set of subscribed users
         self.sessions = dict()
         self.settings_dict = settings_dict
         self.mappings_dict = mappings_dict
@@ -53,10 +76,20 @@ class CuemsWsServer():
             logger.error(f'can not read settings {e}')
             raise e
         logger.debug(f'library path set to : {self.library_path}')
+        self.executor_workers = self.settings_dict.get('executor_workers', EXECUTOR_WORKERS)
+        self.fast_lane_workers = self.settings_dict.get('fast_lane_workers', FAST_LANE_WORKERS)
+        self.heavy_lane_workers = self.settings_dict.get('heavy_lane_workers', HEAVY_LANE_WORKERS)
+        # heavy work of all users together never takes every executor thread, so cheap reads always get one
+        self.heavy_global_limit = self.settings_dict.get('heavy_global_limit', max(1, self.executor_workers - 2))
+        self.outgoing_queue_limit = self.settings_dict.get('outgoing_queue_limit', OUTGOING_QUEUE_LIMIT)
+        self.notify_coalesce_window = self.settings_dict.get('notify_coalesce_window', NOTIFY_COALESCE_WINDOW)
+        self.engine_timeouts = dict(ENGINE_TIMEOUTS)
+        self.engine_timeouts.update(self.settings_dict.get('engine_timeouts', dict()))
 
         if (not os.path.exists(self.tmp_path)) or ( not os.access(self.tmp_path,  os.X_OK & os.R_OK & os.W_OK)):
             logger.error("error: upload folder is not usable")
             raise FileNotFoundError('Can not access upload folder')
+        self.upload_store = CuemsUploadStore(self.tmp_path, os.path.join(self.library_path, MEDIA_FOLDER_NAME), self.settings_dict.get('upload_max_age', UPLOAD_MAX_AGE), self.settings_dict.get('upload_max_bytes', UPLOAD_MAX_BYTES))
 
 
     def start(self, port):
@@ -69,18 +102,26 @@ class CuemsWsServer():
 
     def run_async_server(self):
         self.db = CuemsDBManager(self.settings_dict)
+        self.upload_store.collect_garbage()   # partial uploads abandoned while the server was down
         self.event_loop = asyncio.new_event_loop()
         asyncio.set_event_loop(self.event_loop)
-        self.executor =  concurrent.futures.ThreadPoolExecutor(thread_name_prefix='ws_ProjectManager_ThreadPoolExecutor', max_workers=5) # TODO: adjust max workers
+        self.executor =  concurrent.futures.ThreadPoolExecutor(thread_name_prefix='ws_ProjectManager_ThreadPoolExecutor', max_workers=self.executor_workers)
+        self.heavy_slots = asyncio.Semaphore(self.heavy_global_limit)
+        self.upload_write_slots = asyncio.Semaphore(self.settings_dict.get('upload_concurrent_writes', UPLOAD_CONCURRENT_WRITES))
         #self.event_loop.set_exception_handler(self.exception_handler) ### TODO:UNCOMENT FOR PRODUCTION 
         self.project_server = ws.serve(self.connection_handler, self.host, self.port, max_size=None) #TODO: choose max packets size from ui and limit it here
         for sig in (signal.SIGINT, signal.SIGTERM):
             self.event_loop.add_signal_handler(sig, self.ask_exit)
         logger.info('server listening on {}, port {}'.format(self.host, self.port))
         self.event_loop.run_until_complete(self.project_server)
-        self.queue_task = self.event_loop.create_task(self.queue_handler())
+        self.engine_reader = threading.Thread(target=self.engine_queue_reader, name='ws_EngineQueueReader', daemon=True)
+        self.engine_reader.start()
         self.event_loop.run_forever()
+        self.engine_reader_stop.set()
+        self.engine_reader.join()
         self.event_loop.close()
+        self.executor.shutdown(wait=True)
+        self.db.close()
         
     def stop(self):
         os.kill(self.process.pid, signal.SIGTERM)
@@ -88,7 +129,7 @@ class CuemsWsServer():
         logger.info('ws process joined')
         
     def ask_exit(self):
-        #self.event_loop.call_soon_threadsafe(self.queue_task.cancel)
+        self.engine_reader_stop.set()
         self.event_loop.call_soon_threadsafe(self.project_server.ws_server.close)
         logger.info('ws server closing')
         asyncio.run_coroutine_threadsafe(self.stop_async(), self.event_loop)
@@ -100,21 +141,87 @@ class CuemsWsServer():
         self.event_loop.call_soon(self.event_loop.stop)
         logger.info('event loop stoped')
     
-    @asyncio.coroutine
-    def async_get(self):
-
-        """ Calls q.get() in a separate Thread. 
-        q.get is an I/O call, so it should release the GIL.
+    def engine_queue_reader(self):
+        """ Long lived thread draining the engine queue.
+        Blocks on q.get() (releases the GIL), then takes whatever else is already queued
+        and hands the whole batch to the event loop in one call.
         """
-        return (yield from self.event_loop.run_in_executor(concurrent.futures.ThreadPoolExecutor(thread_name_prefix='ws_QueueGet_ThreadPoolExecutor', max_workers=2), 
-                                           self.editor_queue.get))
-
-    async def queue_handler(self):
-        while True:
-            item = await self.async_get()
+        window_start = time.monotonic()
+        window_count = 0
+        while not self.engine_reader_stop.is_set():
+            try:
+                batch = [self.editor_queue.get(timeout=ENGINE_QUEUE_POLL_TIMEOUT)]
+            except queue.Empty:
+                batch = []
+            else:
+                while len(batch) < ENGINE_QUEUE_BATCH_SIZE:
+                    try:
+                        batch.append(self.editor_queue.get_nowait())
+                    except queue.Empty:
+                        break
+                self.event_loop.call_soon_threadsafe(self.route_engine_batch, batch)
+
+            window_count += len(batch)
+            now = time.monotonic()
+            if now - window_start >= 1:
+                self.update_engine_queue_stats(window_count / (now - window_start))
+                window_start = now
+                window_count = 0
+
+    def update_engine_queue_stats(self, messages_per_second):
+        try:
+            queue_depth = self.editor_queue.qsize()
+        except NotImplementedError: # not available on every platform (macOS)
+            queue_depth = None
+        self.engine_queue_stats['messages_per_second'] = round(messages_per_second, 2)
+        self.engine_queue_stats['queue_depth'] = queue_depth
+        if messages_per_second or queue_depth:
+            logger.debug(f'engine queue stats {self.engine_queue_stats}')
+
+    def route_engine_batch(self, batch):
+        self.engine_queue_stats['received'] += len(batch)
+        for item in batch:
             logger.debug(f'Received queue message from engine {item}')
-            self.engine_messages.append(item)
-                    
+            self.route_engine_message(item)
+
+    def route_engine_message(self, item):
+        self.expire_engine_messages()
+        try:
+            action_uuid = item['action_uuid']
+        except (KeyError, TypeError):
+            logger.debug(f'engine message without action_uuid, publishing it {item}')
+            try:
+                self.broadcast(json.dumps({"type": "engine", "value": item}), self.subscribers('engine'))
+            except TypeError as e:
+                logger.warning(f'can not encode engine message {item}, {e}')
+            return
+
+        future = self.engine_waiters.pop(action_uuid, None)
+        if future is not None and not future.done():
+            future.set_result(item)
+        else:
+            logger.debug(f'orphaned engine reply {action_uuid}, keeping it for {ENGINE_ORPHAN_TTL} seconds')
+            self.engine_messages[action_uuid] = (time.monotonic(), item)
+
+    def expire_engine_messages(self):
+        deadline = time.monotonic() - ENGINE_ORPHAN_TTL
+        for action_uuid, (arrival_time, message) in list(self.engine_messages.items()):
+            if arrival_time < deadline:
+                logger.warning(f'dropping unclaimed engine reply {message}')
+                del self.engine_messages[action_uuid]
+
+    def engine_reply_future(self, action_uuid):
+        future = self.event_loop.create_future()
+        try:
+            arrival_time, message = self.engine_messages.pop(action_uuid)
+            future.set_result(message)
+        except KeyError:
+            self.engine_waiters[action_uuid] = future
+        return future
+
+    def engine_timeout(self, action):
+        return self.engine_timeouts.get(action, ENGINE_DEFAULT_TIMEOUT)
+
 
     async def connection_handler(self, websocket, path):
         
@@ -134,10 +241,12 @@ class CuemsWsServer():
         try:
             consumer_task = asyncio.create_task(user_session.consumer_handler())
             producer_task = asyncio.create_task(user_session.producer_handler())
-            # start 3 message processing task so a load or any other time consuming action still leaves with 2 tasks running  and interface feels responsive. TODO:discuss this
-            processor_tasks = [asyncio.create_task(user_session.consumer()) for _ in range(3)]
+            dispatcher_task = asyncio.create_task(user_session.consumer())
+            # separate lanes so a long save or deploy never starves list or thumbnail requests of the same user
+            lane_tasks = [asyncio.create_task(user_session.lane_worker(FAST_LANE)) for _ in range(self.fast_lane_workers)]
+            lane_tasks += [asyncio.create_task(user_session.lane_worker(HEAVY_LANE)) for _ in range(self.heavy_lane_workers)]
             
-            done_tasks, pending_tasks = await asyncio.wait([consumer_task, producer_task, *processor_tasks], return_when=asyncio.FIRST_COMPLETED)
+            done_tasks, pending_tasks = await asyncio.wait([consumer_task, producer_task, dispatcher_task, *lane_tasks], return_when=asyncio.FIRST_COMPLETED)
             for task in pending_tasks:
                 task.cancel()
 
@@ -154,6 +263,7 @@ class CuemsWsServer():
     async def register(self, user_session, path):
         logger.info("user registered: {}".format(id(user_session.websocket)))
         self.users[user_session] = None
+        self.subscribe(user_session, DEFAULT_TOPICS)
         await self.notify_users("users")
         user_session.session_id =  await self.check_session(user_session, path)
         await self.load_session(user_session)
@@ -196,37 +306,114 @@ class CuemsWsServer():
     async def unregister(self, user_task):
         logger.info("user unregistered: {}".format(id(user_task.websocket)))
         self.users.pop(user_task, None)
+        self.unsubscribe(user_task, list(user_task.topics))
+        if user_task.flush_handle is not None:
+            user_task.flush_handle.cancel()
+        user_task.stop_cue_stream()
         await self.notify_users("users")
 
 
+    @staticmethod
+    def valid_topic(topic):
+        return isinstance(topic, str) and (topic in DEFAULT_TOPICS or (topic.startswith(PROJECT_TOPIC_PREFIX) and len(topic) > len(PROJECT_TOPIC_PREFIX)))
+
+    def subscribe(self, user, topics):
+        for topic in topics:
+            if not self.valid_topic(topic):
+                raise ValueError('unknown topic: {}'.format(topic))
+        for topic in topics:
+            self.topics.setdefault(topic, set()).add(user)
+            user.topics.add(topic)
+
+    def unsubscribe(self, user, topics):
+        for topic in topics:
+            subscribers = self.topics.get(topic)
+            if subscribers is not None:
+                subscribers.discard(user)
+                if not subscribers:
+                    del self.topics[topic]
+            user.topics.discard(topic)
+
+    def subscribers(self, topic):
+        return list(self.topics.get(topic, ()))
+
+    def set_loaded_project(self, user, project_uuid):
+        """ Keeps the project:<uuid> subscription of a user on the project it has loaded """
+        previous_uuid = self.users.get(user)
+        if previous_uuid is not None and str(previous_uuid) != str(project_uuid):
+            self.unsubscribe(user, [PROJECT_TOPIC_PREFIX + str(previous_uuid)])
+        self.users[user] = project_uuid
+        self.subscribe(user, [PROJECT_TOPIC_PREFIX + str(project_uuid)])
+
     async def notify_others_list_changes(self, calling_user, list_type):
-        if self.users:  #notify others, not the user trigering the action, and only if the have same project loaded
+        if self.users:  #notify others subscribed to the list, not the user trigering the action
             message = json.dumps({"type": "list_update", "value": list_type})
-            for user, project in self.users.items():
-                if user is not calling_user:
-                    await user.outgoing.put(message)
-                    logger.debug('notifing {} {}'.format(user, list_type))
+            self.broadcast_coalesced(message, [user for user in self.subscribers(list_type) if user is not calling_user])
+            logger.debug('notifing list changes {}'.format(list_type))
             
     async def notify_others_same_project(self, calling_user, msg_type, project_uuid=None):
         if self.users:  #notify others, not the user trigering the action, and only if the have same project loaded
+            if project_uuid is None:
+                project_uuid = self.users.get(calling_user)
             message = json.dumps({"type" : "project_update", "value" : project_uuid})
-            for user, project in self.users.items():
-                if user is not calling_user:
-                    if project_uuid is not None:
-                        if str(project) != str(project_uuid):
-                            continue
-                    else:
-                        if str(project) != str(self.users[calling_user]):
-                            continue
-
-                    logger.debug('same project loaded')
-                    await user.outgoing.put(message)
-                    logger.debug('notifing {}'.format(user))
+            self.broadcast_coalesced(message, [user for user in self.subscribers(PROJECT_TOPIC_PREFIX + str(project_uuid)) if user is not calling_user])
+            logger.debug('notifing same project loaded {}'.format(project_uuid))
     
+    async def notify_others_project_diff(self, calling_user, project_uuid, revision, diff):
+        """ Pushes what changed in a saved project to its other editors, they apply it if they are at revision - 1
+        and reload otherwise. Falls back to the project_update reload hint when there is no diff.
+        """
+        if diff is None:
+            await self.notify_others_same_project(calling_user, "project_modified", project_uuid)
+            return
+        if self.users:
+            message = json.dumps({"type": "project_diff", "value": {"uuid": project_uuid, "base_revision": revision - 1, "revision": revision, "patch": diff}})
+            self.broadcast(message, [user for user in self.subscribers(PROJECT_TOPIC_PREFIX + str(project_uuid)) if user is not calling_user])
+            logger.debug('pushing project diff {} revision {}'.format(project_uuid, revision))
+
     async def notify_users(self, type):
-        if self.users:  # asyncio.wait doesn't accept an empty dcit
-            message = self.users_event(type)
-            await asyncio.wait([user.outgoing.put(message) for user in self.users])
+        if self.users:
+            self.broadcast(self.users_event(type), self.subscribers('users'))
+
+    def broadcast(self, message, users):
+        """ Queues one already encoded message to every user, never waiting on any of them.
+        Users whose outgoing queue is over the limit are not keeping up and get disconnected.
+        """
+        for user in users:
+            if user.outgoing.qsize() >= self.outgoing_queue_limit:
+                self.drop_slow_user(user)
+                continue
+            user.outgoing.put_nowait(message)
+
+    def broadcast_coalesced(self, message, users):
+        """ Holds the message notify_coalesce_window seconds per user, merging duplicates, and then sends
+        everything held as one update_batch event, so a bulk operation does not trigger a refetch storm
+        """
+        if not self.notify_coalesce_window:
+            self.broadcast(message, users)
+            return
+        for user in users:
+            user.pending_notifications[message] = None  # dict as an ordered set
+            if user.flush_handle is None:
+                user.flush_handle = self.event_loop.call_later(self.notify_coalesce_window, self.flush_notifications, user)
+
+    def flush_notifications(self, user):
+        user.flush_handle = None
+        messages = list(user.pending_notifications)
+        user.pending_notifications.clear()
+        if not messages or user not in self.users:
+            return
+        if len(messages) == 1:
+            self.broadcast(messages[0], [user])
+        else:
+            self.broadcast('{"type": "update_batch", "value": [' + ', '.join(messages) + ']}', [user])
+
+    def drop_slow_user(self, user):
+        if user.slow:
+            return
+        user.slow = True
+        logger.warning('user {} has {} messages waiting, closing its connection'.format(id(user.websocket), user.outgoing.qsize()))
+        self.event_loop.create_task(user.websocket.close(code=1013, reason='too many pending messages'))
 
 
 
@@ -1,14 +1,104 @@
 import json
 import asyncio
+import contextvars
 import uuid as uuid_module
-from datetime import datetime
+from enum import Enum, auto
 import websockets as ws
 
 
 from .CuemsErrors import *
+from .CuemsDBPages import CuemsDBPages
+from .CuemsProjectOutline import CUE_CHUNK_SIZE
+from .CuemsDBBulk import BULK_OK
 from ..log import *
 
 
+# client supplied id of the request being processed, echoed on every response or error to that request
+request_id_var = contextvars.ContextVar('request_id', default=None)
+
+
+FAST_LANE = 'fast'     # cheap reads, kept responsive
+HEAVY_LANE = 'heavy'   # writes, disk heavy reads and engine commands
+
+
+class ActionCost(Enum):
+    LOW = auto()        # quick database read
+    HIGH = auto()       # disk, parsing or xml work
+    ENGINE = auto()     # waits for an engine reply
+
+
+class ActionHandler():
+
+    def __init__(self, method, value=True, write=False, cost=ActionCost.LOW, optional_value=False):
+        self.method = method    # name of the CuemsWsUser coroutine handling the action
+        self.value = value      # handler takes the request "value" as first argument
+        self.optional_value = optional_value    # "value" may be missing, the handler gets None then
+        self.write = write      # action modifies the library
+        self.cost = cost
+
+    @property
+    def lane(self):
+        if self.write or self.cost is not ActionCost.LOW:
+            return HEAVY_LANE
+        return FAST_LANE
+
+    @property
+    def uses_executor(self):
+        return self.cost is not ActionCost.ENGINE and (self.write or self.cost is ActionCost.HIGH)
+
+
+# lists changed by each bulk action, their subscribers get one list_update each
+BULK_LISTS = {
+    'project_delete_bulk':          ('project_list', 'project_trash_list'),
+    'project_restore_bulk':         ('project_list', 'project_trash_list'),
+    'project_trash_delete_bulk':    ('project_trash_list',),
+    'project_trash_empty':          ('project_trash_list',),
+    'file_delete_bulk':             ('file_list', 'file_trash_list'),
+    'file_restore_bulk':            ('file_list', 'file_trash_list'),
+    'file_trash_delete_bulk':       ('file_trash_list',),
+    'file_trash_empty':             ('file_trash_list',),
+}
+
+
+ACTION_HANDLERS = {
+    'project_load':         ActionHandler('send_project', cost=ActionCost.HIGH),
+    'project_load_outline': ActionHandler('send_project_outline', cost=ActionCost.HIGH),
+    'project_load_cues':    ActionHandler('send_project_cues', cost=ActionCost.HIGH),
+    'project_ready':        ActionHandler('project_ready', cost=ActionCost.ENGINE),
+    'hw_discovery':         ActionHandler('hw_discovery', value=False, cost=ActionCost.ENGINE),
+    'project_deploy':       ActionHandler('project_deploy', cost=ActionCost.ENGINE),
+    'project_save':         ActionHandler('received_project', write=True, cost=ActionCost.HIGH),
+    'project_patch':        ActionHandler('request_patch_project', write=True, cost=ActionCost.HIGH),
+    'project_revisions':    ActionHandler('list_project_revisions', cost=ActionCost.HIGH),
+    'project_revision_restore': ActionHandler('request_restore_project_revision', write=True, cost=ActionCost.HIGH),
+    'project_delete':       ActionHandler('request_delete_project', write=True),
+    'project_restore':      ActionHandler('request_restore_project', write=True),
+    'project_trash_delete': ActionHandler('request_delete_project_trash', write=True),
+    'project_list':         ActionHandler('list_project', optional_value=True),
+    'project_duplicate':    ActionHandler('request_duplicate_project', write=True, cost=ActionCost.HIGH),
+    'project_trash_list':   ActionHandler('list_project_trash', optional_value=True),
+    'file_list':            ActionHandler('list_file', optional_value=True),
+    'file_trash_list':      ActionHandler('list_file_trash', optional_value=True),
+    'file_save':            ActionHandler('received_file_data', write=True),
+    'file_load_meta':       ActionHandler('request_file_load_meta'),
+    'file_load_thumbnail':  ActionHandler('request_file_load_thumbnail'),
+    'file_load_waveform':   ActionHandler('request_file_load_waveform'),
+    'file_delete':          ActionHandler('request_delete_file', write=True),
+    'file_restore':         ActionHandler('request_restore_file', write=True),
+    'file_trash_delete':    ActionHandler('request_delete_file_trash', write=True),
+    'project_delete_bulk':          ActionHandler('request_bulk', write=True, cost=ActionCost.HIGH),
+    'project_restore_bulk':         ActionHandler('request_bulk', write=True, cost=ActionCost.HIGH),
+    'project_trash_delete_bulk':    ActionHandler('request_bulk', write=True, cost=ActionCost.HIGH),
+    'project_trash_empty':          ActionHandler('request_bulk', write=True, cost=ActionCost.HIGH, optional_value=True),
+    'file_delete_bulk':             ActionHandler('request_bulk', write=True, cost=ActionCost.HIGH),
+    'file_restore_bulk':            ActionHandler('request_bulk', write=True, cost=ActionCost.HIGH),
+    'file_trash_delete_bulk':       ActionHandler('request_bulk', write=True, cost=ActionCost.HIGH),
+    'file_trash_empty':             ActionHandler('request_bulk', write=True, cost=ActionCost.HIGH, optional_value=True),
+    'subscribe':            ActionHandler('request_subscribe'),
+    'unsubscribe':          ActionHandler('request_unsubscribe'),
+}
+
+
 class CuemsWsUser():
     
     def __init__(self, server, websocket):
@@ -16,8 +106,14 @@ class CuemsWsUser():
         asyncio.set_event_loop(server.event_loop)
         self.incoming = asyncio.Queue()
         self.outgoing = asyncio.Queue()
+        self.lanes = {FAST_LANE: asyncio.Queue(), HEAVY_LANE: asyncio.Queue()}
         self.websocket = websocket
         self.session_id = None
+        self.slow = False   # set when the server drops this user for not reading its messages
+        self.pending_notifications = dict() # encoded notifications waiting for the coalesce window to end
+        self.topics = set()
+        self.flush_handle = None
+        self.cue_stream = None  # task sending the cues of the loaded project after its outline
         server.users[self] = None
 
     async def consumer_handler(self):
@@ -35,115 +131,105 @@ class CuemsWsUser():
             except (ws.exceptions.ConnectionClosed, ws.exceptions.ConnectionClosedOK, ws.exceptions.ConnectionClosedError) as e:
                 logger.debug(e)
                 break
+            finally:
+                self.outgoing.task_done()
 
 
     async def consumer(self):
+        """ Decodes incoming messages and queues them on the lane of their action """
         while True:
             message = await self.incoming.get()
+            request_id_var.set(None)
             try:
                 data = json.loads(message)
             except Exception as e:
                 logger.error("error: {} {}".format(type(e), e))
                 await self.notify_error_to_user('error decoding json') 
                 continue
+            if isinstance(data, dict):
+                request_id_var.set(data.get('request_id'))
             try:
                 if "action" not in data:
                     logger.error("unsupported event: {}".format(data))
                     await self.notify_error_to_user("unsupported event: {}".format(data))
-                elif data["action"] == "project_load":
-                    await self.send_project(data["value"], data["action"])
-                elif data["action"] == "project_ready":
-                    await self.project_ready(data["value"], data["action"])
-                elif data["action"] == "hw_discovery":
-                    await self.hw_discovery(data["action"])
-                elif data["action"] == "project_deploy":
-                    await self.project_deploy(data["value"], data["action"])
-                elif data["action"] == "project_save":
-                    await self.received_project(data["value"], data["action"])
-                elif data["action"] == "project_delete":
-                    await self.request_delete_project(data["value"], data["action"])
-                elif data["action"] == "project_restore":
-                    await self.request_restore_project(data["value"], data["action"])
-                elif data["action"] == "project_trash_delete":
-                    await self.request_delete_project_trash(data["value"], data["action"])
-                elif data["action"] == "project_list":
-                    await self.list_project(data["action"])
-                elif data["action"] == "project_duplicate":
-                    await self.request_duplicate_project(data["value"], data["action"])
-                elif data["action"] == "file_list":
-                    await self.list_file(data["action"])
-                elif data["action"] == "project_trash_list":
-                    await self.list_project_trash(data["action"])
-                elif data["action"] == "file_trash_list":
-                    await self.list_file_trash(data["action"])
-                elif data["action"] == "file_save":
-                    await self.received_file_data(data["value"], data["action"])
-                elif data["action"] == "file_load_meta":
-                    await self.request_file_load_meta(data["value"], data["action"])
-                elif data["action"] == "file_load_thumbnail":
-                    await self.request_file_load_thumbnail(data["value"], data["action"])
-                elif data["action"] == "file_load_waveform":
-                    await self.request_file_load_waveform(data["value"], data["action"])
-                elif data["action"] == "file_delete":
-                    await self.request_delete_file(data["value"], data["action"])
-                elif data["action"] == "file_restore":
-                    await self.request_restore_file(data["value"], data["action"])
-                elif data["action"] == "file_trash_delete":
-                    await self.request_delete_file_trash(data["value"], data["action"])
-                else:
-                    logger.error("unsupported action: {}".format(data))
-                    await self.notify_error_to_user("unsupported action: {}".format(data))
-            except Exception as e:
-                logger.error("error: {} {}".format(type(e), e))
-                await self.notify_error_to_user('error processing request')
+                    continue
+                handler = ACTION_HANDLERS[data["action"]]
+            except (KeyError, TypeError):
+                logger.error("unsupported action: {}".format(data))
+                await self.notify_error_to_user("unsupported action: {}".format(data))
+                continue
+            await self.lanes[handler.lane].put((handler, data, request_id_var.get()))
+
+    async def lane_worker(self, lane):
+        while True:
+            handler, data, request_id = await self.lanes[lane].get()
+            request_id_var.set(request_id)
+            if handler.uses_executor:
+                async with self.server.heavy_slots:  # server wide cap, leaves executor threads free for reads
+                    await self.dispatch(handler, data)
+            else:
+                await self.dispatch(handler, data)
 
+    async def dispatch(self, handler, data):
+        try:
+            method = getattr(self, handler.method)
+            if handler.optional_value:
+                await method(data.get("value"), data["action"])
+            elif handler.value:
+                await method(data["value"], data["action"])
+            else:
+                await method(data["action"])
+        except Exception as e:
+            logger.error("error: {} {}".format(type(e), e))
+            await self.notify_error_to_user('error processing request')
+
+    async def reply(self, message):
+        request_id = request_id_var.get()
+        if request_id is not None:
+            message["request_id"] = request_id
+        await self.outgoing.put(json.dumps(message))
+
+    async def reply_encoded(self, msg_type, value_json, **fields):
+        """ Sends a response whose value is already json encoded, without decoding and encoding it again """
+        message = '{"type": ' + json.dumps(msg_type) + ', "value": ' + value_json
+        for key, field_value in fields.items():
+            message += ', ' + json.dumps(key) + ': ' + json.dumps(field_value)
+        request_id = request_id_var.get()
+        if request_id is not None:
+            message += ', "request_id": ' + json.dumps(request_id)
+        await self.outgoing.put(message + '}')
 
     async def notify_user(self, msg=None, uuid=None,  action=None, new_uuid=None):
         if (uuid is None) and (action is None) and (msg is not None):
-            await self.outgoing.put(json.dumps({"type": "state", "value":msg}))
+            await self.reply({"type": "state", "value":msg})
         elif (msg is None and new_uuid is None):
-            await self.outgoing.put(json.dumps({"type": action, "value": uuid}))
+            await self.reply({"type": action, "value": uuid})
         elif (msg is None and new_uuid is not None):
-            await self.outgoing.put(json.dumps({"type": action, "value": { "uuid" : uuid, "new_uuid" : new_uuid}}))
+            await self.reply({"type": action, "value": { "uuid" : uuid, "new_uuid" : new_uuid}})
 
     async def notify_error_to_user(self, msg=None, uuid=None, action=None):
         if (msg is not None) and (uuid is None) and (action is None):
-            await self.outgoing.put(json.dumps({"type": "error", "value": msg}))
+            await self.reply({"type": "error", "value": msg})
         elif (action is not None) and (msg is not None) and (uuid is None):
-            await self.outgoing.put(json.dumps({"type": "error", "action": action, "value": msg}))
+            await self.reply({"type": "error", "action": action, "value": msg})
         elif (action is not None) and (msg is not None) and (uuid is not None):
-            await self.outgoing.put(json.dumps({"type": "error", "uuid": uuid, "action": action, "value": msg}))
+            await self.reply({"type": "error", "uuid": uuid, "action": action, "value": msg})
 
     async def comunicate_with_engine(self, action, action_uuid, engine_command):
-        try: 
+        reply = self.server.engine_reply_future(action_uuid)
+        try:
             await self.server.event_loop.run_in_executor(self.server.executor, self.server.engine_queue.put, engine_command)
-
-            start_time = datetime.now()
-            while True:
-                time_delta = datetime.now() - start_time
-                if time_delta.total_seconds() >= 10: #TODO: decide timeout, or get it from settings?
-                    raise TimeoutError(f'Timeout waiting {action} response from engine')
-                if self.server.engine_messages:
-                    for message in list(self.server.engine_messages): #iterate over a copy, so we can remove from the original, (bad idea to modify original while iterating over it)
-                        if "action_uuid" in message:
-                            if action_uuid in message['action_uuid']:
-                                self.server.engine_messages.remove(message)
-                                if 'type'  not in message:
-                                    raise EngineError(f'Engine reports error {message}')
-                                if message['type'] != action or message['value'] != 'OK':
-                                    raise EngineError(f'Engine reports error {message}')
-                                return message['value']
-                    else:
-                        await asyncio.sleep(0.25)
-                        continue
-                    break
-                
-                await asyncio.sleep(0.25)
-
-        except Exception as e:
-            raise e
-
-        
+            message = await asyncio.wait_for(reply, self.server.engine_timeout(action))
+        except asyncio.TimeoutError:
+            raise TimeoutError(f'Timeout waiting {action} response from engine')
+        finally:
+            self.server.engine_waiters.pop(action_uuid, None)
+
+        if 'type' not in message:
+            raise EngineError(f'Engine reports error {message}')
+        if message['type'] != action or message['value'] != 'OK':
+            raise EngineError(f'Engine reports error {message}')
+        return message['value']
 
     async def project_ready(self, project_uuid, action):
         logger.info(f"user {id(self.websocket)} requesting ready project {project_uuid}")
@@ -154,7 +240,7 @@ class CuemsWsUser():
 
             result = await self.comunicate_with_engine(action, action_uuid, engine_command)
 
-            await self.outgoing.put(json.dumps({"type": "project_ready", "value": project_uuid}))
+            await self.reply({"type": "project_ready", "value": project_uuid})
 
         except Exception as e:
             logger.error(f"error: {type(e)} {e}")
@@ -168,7 +254,7 @@ class CuemsWsUser():
 
             result = await self.comunicate_with_engine(action, action_uuid, engine_command)
 
-            await self.outgoing.put(json.dumps({"type": "hw_discovery", "value": result}))
+            await self.reply({"type": "hw_discovery", "value": result})
 
         except Exception as e:
             logger.error("error: {} {}".format(type(e), e))
@@ -183,17 +269,39 @@ class CuemsWsUser():
 
             result = await self.comunicate_with_engine(action, action_uuid, engine_command)
 
-            await self.outgoing.put(json.dumps({"type": "project_deploy", "value": project_uuid}))
+            await self.reply({"type": "project_deploy", "value": project_uuid})
 
         except Exception as e:
             logger.error(f"error: {type(e)} {e}")
             await self.notify_error_to_user(str(e), uuid=project_uuid, action=action )
 
-    async def list_project(self, action):
+    async def send_list(self, action, options, load_list, load_delta, load_page):
+        """ Sends one page when the client asks for pagination, sorting or filtering,
+        only what changed when the client gives the seq of its last list ("since") and it is still recent enough,
+        or else the whole (cached) list
+        """
+        if CuemsDBPages.is_page_request(options):
+            page = await self.server.event_loop.run_in_executor(self.server.executor, load_page, options)
+            await self.reply({"type": action, "value": page['items'], "seq": page['seq'], "next_cursor": page['next_cursor']})
+            return
+
+        since = None
+        if isinstance(options, dict) and options.get('since') is not None:
+            since = int(options['since'])
+
+        if since is not None:
+            delta = await self.server.event_loop.run_in_executor(self.server.executor, load_delta, since)
+            if delta is not None:
+                await self.reply({"type": action + "_delta", "value": delta})
+                return
+
+        seq, list_json = await self.server.event_loop.run_in_executor(self.server.executor, load_list)
+        await self.reply_encoded(action, list_json, seq=seq)
+
+    async def list_project(self, options, action):
         logger.info("user {} loading project list".format(id(self.websocket)))
         try:
-            project_list = await self.server.event_loop.run_in_executor(self.server.executor, self.load_project_list)    
-            await self.outgoing.put(json.dumps({"type": action, "value": project_list}))
+            await self.send_list(action, options, self.load_project_list, self.load_project_list_delta, self.load_project_list_page)
         except Exception as e:
             logger.error("error: {} {}".format(type(e), e))
             await self.notify_error_to_user(str(e),  action=action)
@@ -202,10 +310,12 @@ class CuemsWsUser():
     async def send_project(self, project_uuid, action):
         try:
             logger.info("user {} loading project {}".format(id(self.websocket), project_uuid))
-            project = await self.server.event_loop.run_in_executor(self.server.executor, self.load_project, project_uuid)
-            msg = json.dumps({"type":"project", "value":project})
-            await self.outgoing.put(msg)
-            self.server.users[self] = project_uuid
+            revision, project = await self.server.event_loop.run_in_executor(self.server.executor, self.load_project, project_uuid)
+            self.stop_cue_stream()
+            await self.reply({"type":"project", "value":project, "revision": revision})
+            # another load may have started a stream during the reply, the last one to get here owns it
+            self.stop_cue_stream()
+            self.server.set_loaded_project(self, project_uuid)
             self.server.sessions[self.session_id]['loaded_project']=project_uuid
         except NonExistentItemError as e:
             logger.info(e)
@@ -214,10 +324,72 @@ class CuemsWsUser():
             logger.error("error: {} {}".format(type(e), e))
             await self.notify_error_to_user(str(e), uuid=project_uuid, action=action )
 
+    async def send_project_outline(self, value, action):
+        """ Sends the project with only the outline of its cues, then streams the cue bodies in chunks unless "stream" is false """
+        project_uuid = None
+        try:
+            if isinstance(value, dict):
+                project_uuid = value['uuid']
+                stream = value.get('stream', True)
+                chunk_size = max(1, int(value.get('chunk_size', CUE_CHUNK_SIZE)))
+            else:
+                project_uuid, stream, chunk_size = value, True, CUE_CHUNK_SIZE
+            logger.info("user {} loading project outline {}".format(id(self.websocket), project_uuid))
+            revision, project_outline, cues = await self.server.event_loop.run_in_executor(self.server.executor, self.load_project_outline, project_uuid)
+            self.stop_cue_stream()
+            await self.reply({"type": "project_outline", "value": project_outline, "revision": revision, "cue_count": len(cues)})
+            # no await from here to ensure_future, so a load running next to this one can not leave its stream behind
+            self.stop_cue_stream()
+            self.server.set_loaded_project(self, project_uuid)
+            self.server.sessions[self.session_id]['loaded_project']=project_uuid
+            if stream and cues:
+                self.cue_stream = asyncio.ensure_future(self.stream_cues(project_uuid, revision, cues, chunk_size))
+        except NonExistentItemError as e:
+            logger.info(e)
+            await self.notify_error_to_user(str(e), uuid=project_uuid, action=action)
+        except Exception as e:
+            logger.error("error: {} {}".format(type(e), e))
+            await self.notify_error_to_user(str(e), uuid=project_uuid, action=action)
+
+    async def stream_cues(self, project_uuid, revision, cues, chunk_size):
+        """ Sends the cue bodies one chunk at a time, each once everything queued before it has been sent """
+        try:
+            for start in range(0, len(cues), chunk_size):
+                await self.outgoing.join()
+                await self.reply({"type": "project_cues", "uuid": project_uuid, "revision": revision, "start": start, "value": cues[start:start + chunk_size]})
+            logger.debug("user {} got the {} cues of project {}".format(id(self.websocket), len(cues), project_uuid))
+        except asyncio.CancelledError:
+            logger.debug("user {} cue stream of project {} stopped".format(id(self.websocket), project_uuid))
+            raise
+
+    def stop_cue_stream(self):
+        if self.cue_stream is not None:
+            self.cue_stream.cancel()
+            self.cue_stream = None
+
+    async def send_project_cues(self, value, action):
+        project_uuid = None
+        try:
+            project_uuid = value['uuid']
+            start = int(value['start'])
+            count = int(value['count'])
+            cues = await self.server.event_loop.run_in_executor(self.server.executor, self.load_project_cues, project_uuid, value['revision'], start, count)
+            await self.reply({"type": "project_cues", "uuid": project_uuid, "revision": value['revision'], "start": start, "value": cues})
+        except RevisionConflictError as e:
+            logger.info(e)
+            await self.reply({"type": "error", "uuid": project_uuid, "action": action, "value": str(e), "revision": e.revision})
+        except NonExistentItemError as e:
+            logger.info(e)
+            await self.notify_error_to_user(str(e), uuid=project_uuid, action=action)
+        except Exception as e:
+            logger.error("error: {} {}".format(type(e), e))
+            await self.notify_error_to_user(str(e), uuid=project_uuid, action=action)
+
     async def received_project(self, data, action):
         try:
             project_uuid = None
             new_project = False
+            base_revision = data.pop('revision', None)  # revision the client loaded, next to "CuemsScript"
 
             try:
                 project_uuid = data['CuemsScript']['uuid']
@@ -228,25 +400,84 @@ class CuemsWsUser():
 
             if new_project:
                 project_uuid = await self.server.event_loop.run_in_executor(self.server.executor, self.new_project, data)
+                revision, diff = 0, None
             else:
-                await self.server.event_loop.run_in_executor(self.server.executor, self.update_project, project_uuid, data)
+                if base_revision is None:
+                    raise RevisionConflictError('project_save needs the revision of the loaded project')
+                revision, diff = await self.server.event_loop.run_in_executor(self.server.executor, self.update_project, project_uuid, data, base_revision)
 
             logger.info("user {} saving project {}".format(id(self.websocket), project_uuid))
             
             
-            self.server.users[self] = project_uuid
-            await self.notify_user(uuid=project_uuid, action=action)
+            self.server.set_loaded_project(self, project_uuid)
+            await self.reply({"type": action, "value": project_uuid, "revision": revision})
             await self.server.notify_others_list_changes(self, "project_list")
-            await self.server.notify_others_same_project(self, "project_modified", project_uuid)
+            await self.server.notify_others_project_diff(self, project_uuid, revision, diff)
+        except RevisionConflictError as e:
+            logger.info(e)
+            await self.reply({"type": "error", "uuid": project_uuid, "action": action, "value": str(e), "revision": e.revision})
         except Exception as e:
             logger.error("error: {} {}".format(type(e), e))
             await self.notify_error_to_user((str(type(e)) + str(e)), uuid=project_uuid, action="project_save")
 
-    async def list_project_trash(self, action):
+    async def request_patch_project(self, value, action):
+        project_uuid = None
+        try:
+            project_uuid = value['uuid']
+            logger.info("user {} patching project {} from revision {}".format(id(self.websocket), project_uuid, value['revision']))
+            revision, diff = await self.server.event_loop.run_in_executor(self.server.executor, self.patch_project, project_uuid, value['revision'], value['patch'])
+
+            self.server.set_loaded_project(self, project_uuid)
+            await self.reply({"type": action, "value": project_uuid, "revision": revision})
+            await self.server.notify_others_list_changes(self, "project_list")
+            await self.server.notify_others_project_diff(self, project_uuid, revision, diff)
+        except RevisionConflictError as e:
+            logger.info(e)
+            await self.reply({"type": "error", "uuid": project_uuid, "action": action, "value": str(e), "revision": e.revision})
+        except (NonExistentItemError, PatchError) as e:
+            logger.info(e)
+            await self.notify_error_to_user(str(e), uuid=project_uuid, action=action)
+        except Exception as e:
+            logger.error("error: {} {}".format(type(e), e))
+            await self.notify_error_to_user(str(e), uuid=project_uuid, action=action)
+
+    async def list_project_revisions(self, project_uuid, action):
+        try:
+            logger.info("user {} listing revisions of project {}".format(id(self.websocket), project_uuid))
+            revision, revisions = await self.server.event_loop.run_in_executor(self.server.executor, self.load_project_revisions, project_uuid)
+            await self.reply({"type": action, "uuid": project_uuid, "value": revisions, "revision": revision})
+        except NonExistentItemError as e:
+            logger.info(e)
+            await self.notify_error_to_user(str(e), uuid=project_uuid, action=action)
+        except Exception as e:
+            logger.error("error: {} {}".format(type(e), e))
+            await self.notify_error_to_user(str(e), uuid=project_uuid, action=action)
+
+    async def request_restore_project_revision(self, value, action):
+        project_uuid = None
+        try:
+            project_uuid = value['uuid']
+            logger.info("user {} restoring project {} to revision {}".format(id(self.websocket), project_uuid, value['revision']))
+            revision, diff = await self.server.event_loop.run_in_executor(self.server.executor, self.restore_project_revision, project_uuid, value['revision'], value['base_revision'])
+
+            self.server.set_loaded_project(self, project_uuid)
+            await self.reply({"type": action, "value": project_uuid, "revision": revision})
+            await self.server.notify_others_list_changes(self, "project_list")
+            await self.server.notify_others_project_diff(self, project_uuid, revision, diff)
+        except RevisionConflictError as e:
+            logger.info(e)
+            await self.reply({"type": "error", "uuid": project_uuid, "action": action, "value": str(e), "revision": e.revision})
+        except NonExistentItemError as e:
+            logger.info(e)
+            await self.notify_error_to_user(str(e), uuid=project_uuid, action=action)
+        except Exception as e:
+            logger.error("error: {} {}".format(type(e), e))
+            await self.notify_error_to_user(str(e), uuid=project_uuid, action=action)
+
+    async def list_project_trash(self, options, action):
         logger.info("user {} loading project trash list".format(id(self.websocket)))
         try:
-            project_trash_list = await self.server.event_loop.run_in_executor(self.server.executor, self.load_project_trash_list)    
-            await self.outgoing.put(json.dumps({"type": action, "value": project_trash_list}))
+            await self.send_list(action, options, self.load_project_trash_list, self.load_project_trash_list_delta, self.load_project_trash_list_page)
         except Exception as e:
             logger.error("error: {} {}".format(type(e), e))
             await self.notify_error_to_user(str(e),  action=action)
@@ -271,8 +502,8 @@ class CuemsWsUser():
     async def request_duplicate_project(self, project_uuid, action):
         try:
             logger.info("user {} duplicating project: {}".format(id(self.websocket), project_uuid))
-            new_project_uuid = await self.server.event_loop.run_in_executor(self.server.executor, self.duplicate_project, project_uuid)
-            await self.notify_user(uuid=project_uuid, action=action, new_uuid=new_project_uuid)
+            new_project_uuid, strategies = await self.server.event_loop.run_in_executor(self.server.executor, self.duplicate_project, project_uuid)
+            await self.reply({"type": action, "value": {"uuid": project_uuid, "new_uuid": new_project_uuid}, "strategy": strategies})
             await self.server.notify_others_list_changes(self, "project_list")
             await self.server.notify_others_list_changes(self, "file_list")
         except NonExistentItemError as e:
@@ -311,11 +542,10 @@ class CuemsWsUser():
             logger.error("error: {} {}".format(type(e), e))
             await self.notify_error_to_user(str(e), uuid=project_uuid, action=action)
 
-    async def list_file(self, action):
+    async def list_file(self, options, action):
         logger.info("user {} loading file list".format(id(self.websocket)))
         try:
-            file_list = await self.server.event_loop.run_in_executor(self.server.executor, self.load_file_list)    
-            await self.outgoing.put(json.dumps({"type": action, "value": file_list}))
+            await self.send_list(action, options, self.load_file_list, self.load_file_list_delta, self.load_file_list_page)
         except Exception as e:
             logger.error("error: {} {}".format(type(e), e))
             await self.notify_error_to_user(str(e),  action=action)
@@ -338,7 +568,7 @@ class CuemsWsUser():
             logger.info("user {} loading file meta data {}".format(id(self.websocket), file_uuid))
             
             file_meta_data = await self.server.event_loop.run_in_executor(self.server.executor, self.load_file_meta, file_uuid)
-            await self.outgoing.put(json.dumps({"type": action, "value": file_meta_data}))
+            await self.reply({"type": action, "value": file_meta_data})
         except NonExistentItemError as e:
             logger.info(e)
             await self.notify_error_to_user(str(e), uuid=file_uuid, action=action)
@@ -374,11 +604,10 @@ class CuemsWsUser():
             logger.error("error: {} {}".format(type(e), e))
             await self.notify_error_to_user(str(e), uuid=file_uuid, action=action)
 
-    async def list_file_trash(self, action):
+    async def list_file_trash(self, options, action):
         logger.info("user {} loading file trash list".format(id(self.websocket)))
         try:
-            file_trash_list = await self.server.event_loop.run_in_executor(self.server.executor, self.load_file_trash_list)    
-            await self.outgoing.put(json.dumps({"type": action, "value": file_trash_list}))
+            await self.send_list(action, options, self.load_file_trash_list, self.load_file_trash_list_delta, self.load_file_trash_list_page)
         except Exception as e:
             logger.error("error: {} {}".format(type(e), e))
             await self.notify_error_to_user(str(e),  action=action)
@@ -425,10 +654,58 @@ class CuemsWsUser():
             logger.error("error: {} {}".format(type(e), e))
             await self.notify_error_to_user(str(e), uuid=file_uuid, action=action)
 
+    async def request_bulk(self, uuids, action):
+        """ Trash actions on a list of uuids (or the whole trash), replies with the result of each one """
+        try:
+            if uuids is not None and not isinstance(uuids, list):
+                raise ValueError('{} value must be a list of uuids'.format(action))
+            logger.info("user {} {} {}".format(id(self.websocket), action, 'all' if uuids is None else len(uuids)))
+            results = await self.server.event_loop.run_in_executor(self.server.executor, self.bulk_trash, action, uuids)
+            await self.reply({"type": action, "value": results})
+
+            done = [uuid for uuid, result in results.items() if result == BULK_OK]
+            if done:
+                if action == 'project_delete_bulk':
+                    for project_uuid in done:
+                        await self.server.notify_others_same_project(self, "project_update", project_uuid=project_uuid)
+                for list_type in BULK_LISTS[action]:
+                    await self.server.notify_others_list_changes(self, list_type)
+        except Exception as e:
+            logger.error("error: {} {}".format(type(e), e))
+            await self.notify_error_to_user(str(e), action=action)
+
+    async def request_subscribe(self, topics, action):
+        try:
+            if isinstance(topics, str):
+                topics = [topics]
+            self.server.subscribe(self, topics)
+            await self.reply({"type": action, "value": sorted(self.topics)})
+        except Exception as e:
+            logger.error("error: {} {}".format(type(e), e))
+            await self.notify_error_to_user(str(e), action=action)
+
+    async def request_unsubscribe(self, topics, action):
+        try:
+            if isinstance(topics, str):
+                topics = [topics]
+            self.server.unsubscribe(self, topics)
+            await self.reply({"type": action, "value": sorted(self.topics)})
+        except Exception as e:
+            logger.error("error: {} {}".format(type(e), e))
+            await self.notify_error_to_user(str(e), action=action)
+
     # call blocking functions asynchronously with run_in_executor ThreadPoolExecutor
     def load_project_list(self):
         logger.info("loading project list")
-        return self.server.db.project.list()
+        return self.server.db.project.list_json()
+
+    def load_project_list_delta(self, since):
+        logger.info("loading project list changes since {}".format(since))
+        return self.server.db.project.list_delta(since)
+
+    def load_project_list_page(self, options):
+        logger.info("loading project list page {}".format(options))
+        return self.server.db.project.list_page(options)
 
     def get_project_unix_name(self, project_uuid):
         logger.info("loading project unix_name")
@@ -439,13 +716,25 @@ class CuemsWsUser():
         logger.info("loading project: {}".format(project_uuid))
         return self.server.db.project.load(project_uuid)
 
+    def load_project_outline(self, project_uuid):
+        logger.info("loading project outline: {}".format(project_uuid))
+        return self.server.db.project.load_outline(project_uuid)
+
+    def load_project_cues(self, project_uuid, revision, start, count):
+        logger.info("loading project cues: {}, revision {}, from {} count {}".format(project_uuid, revision, start, count))
+        return self.server.db.project.load_cues(project_uuid, revision, start, count)
+
     def new_project(self, data):
         logger.debug('saving new project, data:{}'.format(data))
         return self.server.db.project.new(data)
 
-    def update_project(self, project_uuid, data):
-        logger.debug('saving project, uuid:{}, data:{}'.format(project_uuid, data))
-        self.server.db.project.update(project_uuid, data)
+    def update_project(self, project_uuid, data, base_revision):
+        logger.debug('saving project, uuid:{}, revision:{}, data:{}'.format(project_uuid, base_revision, data))
+        return self.server.db.project.update(project_uuid, data, base_revision=base_revision)
+
+    def patch_project(self, project_uuid, base_revision, operations):
+        logger.debug('patching project, uuid:{}, revision:{}, patch:{}'.format(project_uuid, base_revision, operations))
+        return self.server.db.project.patch(project_uuid, base_revision, operations)
 
     def duplicate_project(self, project_uuid):
         logger.debug('duplicating project, uuid:{}'.format(project_uuid))
@@ -457,16 +746,56 @@ class CuemsWsUser():
     def restore_project(self, project_uuid):
         self.server.db.project.restore(project_uuid)
 
+    def load_project_revisions(self, project_uuid):
+        logger.info("loading revisions of project: {}".format(project_uuid))
+        return self.server.db.project.list_revisions(project_uuid)
+
+    def restore_project_revision(self, project_uuid, revision, base_revision):
+        logger.debug('restoring project, uuid:{}, to revision:{}, from revision:{}'.format(project_uuid, revision, base_revision))
+        return self.server.db.project.restore_revision(project_uuid, revision, base_revision)
+
+    def bulk_trash(self, action, uuids):
+        project, media = self.server.db.project, self.server.db.media
+        if action == 'project_trash_empty':
+            return project.empty_trash()
+        if action == 'file_trash_empty':
+            return media.empty_trash()
+        functions = {
+            'project_delete_bulk': project.delete_bulk,
+            'project_restore_bulk': project.restore_bulk,
+            'project_trash_delete_bulk': project.delete_from_trash_bulk,
+            'file_delete_bulk': media.delete_bulk,
+            'file_restore_bulk': media.restore_bulk,
+            'file_trash_delete_bulk': media.delete_from_trash_bulk,
+        }
+        return functions[action](uuids)
+
     def load_project_trash_list(self):
         logger.info("loading project trash list")
-        return self.server.db.project.list_trash()
+        return self.server.db.project.list_trash_json()
+
+    def load_project_trash_list_delta(self, since):
+        logger.info("loading project trash list changes since {}".format(since))
+        return self.server.db.project.list_trash_delta(since)
+
+    def load_project_trash_list_page(self, options):
+        logger.info("loading project trash list page {}".format(options))
+        return self.server.db.project.list_page(options, trash=True)
 
     def delete_project_trash(self, project_uuid):
         self.server.db.project.delete_from_trash(project_uuid)
 
     def load_file_list(self):
         logger.info("loading file list")
-        return self.server.db.media.list()
+        return self.server.db.media.list_json()
+
+    def load_file_list_delta(self, since):
+        logger.info("loading file list changes since {}".format(since))
+        return self.server.db.media.list_delta(since)
+
+    def load_file_list_page(self, options):
+        logger.info("loading file list page {}".format(options))
+        return self.server.db.media.list_page(options)
 
     def load_file_meta(self, uuid):
         logger.info("loading file meta")
@@ -493,7 +822,15 @@ class CuemsWsUser():
 
     def load_file_trash_list(self):
         logger.info("loading file trash list")
-        return self.server.db.media.list_trash()
+        return self.server.db.media.list_trash_json()
+
+    def load_file_trash_list_delta(self, since):
+        logger.info("loading file trash list changes since {}".format(since))
+        return self.server.db.media.list_trash_delta(since)
+
+    def load_file_trash_list_page(self, options):
+        logger.info("loading file trash list page {}".format(options))
+        return self.server.db.media.list_page(options, trash=True)
 
     def delete_file_trash(self, file_uuid):
         self.server.db.media.delete_from_trash(file_uuid)
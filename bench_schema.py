@@ -0,0 +1,37 @@
+# per save cost of writing a project with a new XmlWriter (schema compiled every time) and with the cached one
+# run as a module from the parent package: python -m <package>.bench_schema path/to/script.xml [saves]
+import os
+import sys
+import time
+import tempfile
+
+from .CuemsCache import CuemsSchemaCache
+from .CuemsProjectManager import SCRIPT_SCHEMA_FILE_PATH
+from ..DictParser import CuemsParser
+from ..XmlReaderWriter import XmlReader, XmlWriter
+
+
+script_path = sys.argv[1]
+saves = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+data = XmlReader(schema = SCRIPT_SCHEMA_FILE_PATH, xmlfile = script_path).read()
+project_object = CuemsParser(data).parse()
+out_path = os.path.join(tempfile.mkdtemp(), 'script.xml')
+
+start = time.perf_counter()
+for _ in range(saves):
+    XmlWriter(schema = SCRIPT_SCHEMA_FILE_PATH, xmlfile = out_path).write_from_object(project_object)
+before = (time.perf_counter() - start) / saves
+
+schema_cache = CuemsSchemaCache(SCRIPT_SCHEMA_FILE_PATH)
+start = time.perf_counter()
+for _ in range(saves):
+    schema_cache.writer(out_path).write_from_object(project_object)
+after = (time.perf_counter() - start) / saves
+
+print('{} saves of {}'.format(saves, script_path))
+print('new writer per save:  {:.2f} ms/save'.format(before * 1000))
+print('cached schema writer: {:.2f} ms/save ({} schema compilations)'.format(after * 1000, schema_cache.builds))
+
+os.remove(out_path)
+os.rmdir(os.path.dirname(out_path))
@@ -0,0 +1,44 @@
+# checks that loading a project after a save gives the same dict as a cold load of its script.xml
+# run as a module from the parent package: python -m <package>.check_project_cache path/to/script.xml
+import os
+import sys
+import copy
+import shutil
+import tempfile
+
+from .CuemsCache import CuemsSchemaCache, CuemsProjectCache
+from .CuemsDBProject import CuemsDBProject, PROJECT_FOLDER_NAME, SCRIPT_FILE_NAME
+from .CuemsProjectManager import SCRIPT_SCHEMA_FILE_PATH
+from .CuemsProjectWorker import read_project
+from .CuemsUtils import date_now_iso_utc
+
+
+script_path = sys.argv[1]
+unix_name = 'check_project_cache'
+
+library_path = tempfile.mkdtemp()
+os.makedirs(os.path.join(library_path, PROJECT_FOLDER_NAME, unix_name))
+xml_path = os.path.join(library_path, PROJECT_FOLDER_NAME, unix_name, SCRIPT_FILE_NAME)
+shutil.copyfile(script_path, xml_path)
+
+schema_cache = CuemsSchemaCache(SCRIPT_SCHEMA_FILE_PATH)
+# only the xml methods are used, they do not touch the database, changes or revisions
+project = CuemsDBProject(library_path, schema_cache, None, None, None, CuemsProjectCache(), None)
+try:
+    loaded = project.load_xml(unix_name)
+    assert loaded == read_project(schema_cache, xml_path), 'cached load differs from a cold load'
+
+    # saved as update does: client form, without unix_name and with a new modified date
+    data = copy.deepcopy(loaded)
+    data['CuemsScript'].pop('unix_name', None)
+    data['CuemsScript']['modified'] = date_now_iso_utc()
+    tmp_path, media_names = project.write_xml(unix_name, data)
+    project.save_xml(unix_name, tmp_path)
+
+    after_save = project.load_xml(unix_name)
+    cold = read_project(schema_cache, xml_path)
+    assert after_save == cold, 'load after a save differs from a cold load'
+    assert project.load_xml(unix_name) == cold, 'cached load after a save differs from a cold load'
+    print('load after save matches a cold load of {}'.format(script_path))
+finally:
+    shutil.rmtree(library_path)